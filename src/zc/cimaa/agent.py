@@ -1,18 +1,26 @@
 import argparse
 import datetime
+import gevent.lock
+import gevent.pool
+import gevent.queue
+import hashlib
 import gevent.subprocess
 import json
 import logging
 import os
 import re
+import shlex
 import signal
 import socket
 import sys
+import threading
 import time
 
 import zc.cimaa.nagiosperf
 import zc.cimaa.parser
+import zc.cimaa.squelch
 import zc.cimaa.threshold
+import zc.cimaa.util
 
 logger = logging.getLogger(__name__)
 
@@ -46,40 +54,64 @@ class Agent:
                 options.get('timeout', self.base_interval * .7))
             self.alert_timeout = float(
                 options.get('alert_timeout', self.base_interval * .2))
+            self.max_concurrent_checks = int(
+                options.get('max_concurrent_checks', 0)) or None
+            max_concurrent_alerts = int(
+                options.get('max_concurrent_alerts', 0))
+            if max_concurrent_alerts:
+                self.alert_slots = gevent.lock.BoundedSemaphore(
+                    max_concurrent_alerts)
+            alert_rate = float(options.get('alert_rate', 0))
+            if alert_rate:
+                self.alert_limiter = RateLimiter(
+                    alert_rate,
+                    float(options.get('alert_burst', max(alert_rate, 1))))
+            self.defer_alerts = (
+                options.get('defer_alerts', 'false').lower() == 'true')
+            self.unresolved = set()
+            self.spread = options.get('spread', 'false').lower() == 'true'
+            self.self_metrics = (
+                options.get('self_metrics', 'false').lower() == 'true')
+            self.lease_name = options.get('lease', 'global-checks')
+            self.lease_duration = float(
+                options.get('lease_duration', self.base_interval * 3))
+            if self.spread:
+                self.offset = self.base_interval * spread(aname)
 
             self.db = zc.cimaa.parser.load_handler(config['database'])
             self.alerter = zc.cimaa.parser.load_handler(config['alerter'])
             if 'metrics' in config:
                 self.metric = zc.cimaa.parser.load_handler(config['metrics'])
-
-            self._set_critical(self.db.get_faults(self.name))
-
-            directory = options['directory']
-            self.checks = checks = []
-            for name in os.listdir(directory):
-                if name.endswith('.cfg'):
-                    path = os.path.join(directory, name)
-                    fname = name[:-4]
-                    prefix = '//%s/%s/' % (aname, fname)
-                    try:
-                        cparser = zc.cimaa.parser.parse_file(path)
-                    except zc.cimaa.parser.Error:
-                        checks.append(BadCheck(prefix, path,
-                                               'error parsing %s' % path))
-                    else:
-                        for section in cparser:
-                            config = dict(cparser[section])
-                            if section.startswith('//'):
-                                fullname = section
-                            else:
-                                fullname = prefix + section
-                            try:
-                                checks.append(Check(fullname, config))
-                            except zc.cimaa.parser.Error as e:
-                                checks.append(BadCheck(
-                                    prefix, section,
-                                    'error loading check %s [%s]: %s'
-                                    % (path, section, e)))
+                queue_size = int(options.get('metrics_queue_size', 0))
+                if queue_size:
+                    self.metric = MetricQueue(self.metric, queue_size)
+
+            self.state_file = options.get('state_file')
+            self.state_max_age = float(
+                options.get('state_max_age', self.base_interval * 5))
+            state = self._load_state()
+            if state is None:
+                self.last_faults = list(self.db.get_faults(self.name))
+            else:
+                self.last_faults = state['faults']
+                restore_faults = getattr(self.db, 'restore_faults', None)
+                if restore_faults is not None and not state.get('removed'):
+                    restore_faults(self.name, state['faults'])
+            self._set_critical(self.last_faults)
+
+            self.squelches = zc.cimaa.squelch.Matcher()
+
+            self.directory = options['directory']
+            self.reload_checks = (
+                options.get('reload_checks', 'false').lower() == 'true')
+            self.check_files = {}
+            self._load_checks()
+
+            if state is not None:
+                failures = state['failures']
+                for check in self.checks:
+                    if check.name in failures:
+                        check.failures = failures[check.name]
 
             signal.signal(signal.SIGTERM, self.shutdown)
 
@@ -87,6 +119,141 @@ class Agent:
             logger.exception("Encountered exception during startup:")
             raise
 
+    def _load_state(self):
+        """Load saved state, if there's a state file and it's not stale
+        """
+        if not (self.state_file and os.path.exists(self.state_file)):
+            return None
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            if time.time() - state['updated'] > self.state_max_age:
+                return None
+            state['faults'], state['failures'] # Make sure they're there
+        except Exception:
+            logger.exception("Couldn't load state from %s", self.state_file)
+            return None
+        return state
+
+    def _save_state(self, faults, removed=False):
+        """Save faults and check failure counts
+
+        The data are written to a temporary file that's then renamed, so
+        a crash doesn't leave a partially-written state file.  Errors
+        are logged, rather than raised, so they don't stop the agent.
+        """
+        if not self.state_file:
+            return
+        state = dict(
+            updated=time.time(),
+            faults=faults,
+            failures=dict((check.name, check.failures)
+                          for check in self.checks if check.failures),
+            )
+        if removed:
+            state['removed'] = True
+        tmp = self.state_file + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.state_file)
+        except Exception:
+            logger.exception("Couldn't save state to %s", self.state_file)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def _load_checks(self, reloading=False):
+        """Load check configuration files that are new or have changed
+
+        Checks in files that haven't changed are kept, along with their
+        state.  Return the names of checks that were removed.
+
+        If the directory can't be read when reloading, the error is
+        logged and the loaded checks are kept.
+        """
+        old_files = self.check_files
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            if not reloading:
+                raise
+            logger.exception("Couldn't reload checks from %s", self.directory)
+            return set()
+
+        files = {}
+        for name in names:
+            if name.endswith('.cfg'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue # Removed since we listed it
+                key = stat.st_mtime, stat.st_size
+                old = old_files.get(name)
+                if old is not None and old[0] == key:
+                    files[name] = old
+                else:
+                    if old is not None:
+                        logger.info("Reloading %s", path)
+                    files[name] = key, self._load_file(
+                        name, path, old[1] if old is not None else ())
+
+        new = set(check for key, checks in files.values()
+                  for check in checks)
+        removed = set()
+        for key, checks in old_files.values():
+            for check in checks:
+                if check not in new:
+                    check.stop()
+                    removed.add(check.name)
+
+        self.check_files = files
+        self.checks = [check for name in sorted(files)
+                       for check in files[name][1]]
+        return removed - set(check.name for check in new)
+
+    def _load_file(self, name, path, old_checks):
+        aname = self.name
+        fname = name[:-4]
+        prefix = '//%s/%s/' % (aname, fname)
+        try:
+            cparser = zc.cimaa.parser.parse_file(path)
+        except zc.cimaa.parser.Error:
+            return [BadCheck(prefix, path, 'error parsing %s' % path)]
+
+        checks = []
+        for section in cparser:
+            config = dict(cparser[section])
+            if section.startswith('//'):
+                fullname = section
+            else:
+                fullname = prefix + section
+            try:
+                checks.append(check_class(config)(fullname, config))
+            except Exception as e:
+                # Including bad option values, so a typo in a reloaded
+                # file doesn't stop the agent.
+                checks.append(BadCheck(
+                    prefix, section,
+                    'error loading check %s [%s]: %s'
+                    % (path, section, e)))
+
+        if self.spread:
+            for check in checks:
+                check.phase = int(check.interval * spread(aname, check.name))
+
+        # Checks that were reloaded keep counting failures:
+        failures = dict((check.name, check.failures) for check in old_checks)
+        for check in checks:
+            if check.name in failures:
+                check.failures = failures[check.name]
+
+        return checks
+
     def _set_critical(self, faults):
         self.critical = dict(
             (f['name'], f['message'] if f.get('triggered') else -1)
@@ -94,11 +261,57 @@ class Agent:
             if f['severity'] >= logging.CRITICAL
             )
 
+    def due(self, minute):
+        """Return the checks that should be run for the given minute.
+
+        This is decided before any checks are started, so checks that
+        aren't due don't cost a greenlet or subprocess.  Global checks
+        are only run if this agent holds the global-check lease.
+        """
+        checks = [check for check in self.checks if check.should_run(minute)]
+        if self.has_global_checks() and not self.lead():
+            checks = [check for check in checks if not check.is_global]
+        return checks
+
+    def has_global_checks(self):
+        for check in self.checks:
+            if check.is_global:
+                return True
+        return False
+
+    def lead(self):
+        """Try to acquire or renew the lease to perform global checks
+
+        If the database doesn't support leases, global checks are
+        performed by every agent.
+        """
+        acquire_lease = getattr(self.db, 'acquire_lease', None)
+        if acquire_lease is None:
+            return True
+        try:
+            return acquire_lease(
+                self.lease_name, self.name, self.lease_duration)
+        except Exception:
+            logger.exception("Couldn't acquire lease %r", self.lease_name)
+            return False
+
     def perform(self, minute):
-        # start checks. XXX maybe we want to limit the number of checks
-        # running at once.
-        checklets = [(check, gevent.spawn(check.perform))
-                     for check in self.checks]
+        start = time.time()
+        if self.reload_checks:
+            removed = self._load_checks(reloading=True)
+        else:
+            removed = ()
+        # Start checks, at most max_concurrent_checks at a time, in
+        # priority order.
+        runtimes = {}
+        checklets = [(check, gevent.Greenlet(self._perform, check, runtimes))
+                     for check in self.due(minute)]
+        starter = gevent.spawn(
+            self._start,
+            gevent.pool.Pool(self.max_concurrent_checks),
+            [checklet for check, checklet
+             in sorted(checklets, key=lambda c: c[0].start_order())],
+            )
 
         deadline = time.time() + self.timeout
         faults = []
@@ -107,16 +320,25 @@ class Agent:
         squelches = None
         squelched = set()
         alerts = []
+        metrics = []
+        timed_out = 0
         for check, checklet in checklets:
-            if not check.should_run(minute):
-                continue
             checked.add(check.name)
             timeout = max(0, deadline - time.time())
             checklet.join(timeout)
             cresults = checklet.value
             if cresults is None:
+                # Don't start checks that are still waiting in the pool:
+                starter.kill()
                 checklet.kill(block=False)
                 cresults = dict(faults=[monitor_error('timeout')])
+                timed_out += 1
+            elif self.self_metrics:
+                metrics.append((check.name + '#monitor-time',
+                                runtimes[check.name], 's'))
+                if check.returncode is not None:
+                    metrics.append((check.name + '#monitor-status',
+                                    check.returncode, ''))
 
             for f in cresults.get('faults', ()):
                 if f.get('name', ''):
@@ -127,10 +349,12 @@ class Agent:
                 faults.append(f)
                 if f['severity'] >= logging.CRITICAL:
                     if squelches is None:
-                        squelches = self.db.get_squelches()
-                    for squelch in squelches:
-                        if re.search(squelch, name):
-                            break
+                        squelches = self.squelches
+                        squelches.update(self.db.get_squelches())
+                    squelch = squelches.match(name)
+                    if squelch is not None:
+                        logger.info("%s squelched by %r", name, squelch)
+                        squelched.add(name)
                     else:
                         message = f['message']
                         critical[name] = f
@@ -145,34 +369,151 @@ class Agent:
                 m['name'] = check.name + '#' + m['name']
                 self.metric(**m)
 
+        # Resolve faults for checks that were removed:
+        checked.update(removed)
+        # (Including resolves that failed or were deferred before.)
+        resolves = set(name for name in self.unresolved
+                       if name not in critical)
         for name in self.critical:
             if name not in critical and name.split('#')[0] in checked:
-                alerts.append(self.resolve(name))
+                resolves.add(name)
+        self.unresolved = set()
+        for name in sorted(resolves):
+            alerts.append(self.resolve(name))
 
-        deadline = time.time() + self.alert_timeout
+        alert_start = time.time()
+        deadline = alert_start + self.alert_timeout
         alert_failed = 0
         for alert in alerts:
             timeout = max(deadline - time.time(), 0.0)
             alert.join(timeout)
             if not alert.value:
                 exception = alert.exception
+                resolving = getattr(alert, 'resolving', None)
+                if exception is None and self.defer_alerts:
+                    # Try again next time.  Triggers are retried
+                    # because they weren't marked as triggered.
+                    alert.kill(block=False)
+                    logger.warning("Alert deferred")
+                    if resolving:
+                        self.unresolved.add(resolving)
+                    continue
                 logger.error("Alert failed: %s",
                              "timeout" if exception is None else
                              "%s: %s" % (exception.__class__.__name__,
                                          exception))
+                if exception is not None and resolving:
+                    self.unresolved.add(resolving)
+                alert_failed += 1
+
+        # Let alerters that batch alerts send them:
+        alert_count = len(alerts)
+        flush = getattr(self.alerter, 'flush', None)
+        if flush is not None:
+            alert_count += 1
+            if not self._flush_alerts(flush, deadline):
                 alert_failed += 1
 
         if alert_failed:
             faults.append(dict(
                 name = self.name + '#alerts',
                 message = "Failed to send alert information (%s/%s)" % (
-                    alert_failed, len(alerts)),
+                    alert_failed, alert_count),
                 severity = logging.CRITICAL,
                 updated = time.time(),
                 ))
 
+        alert_time = time.time() - alert_start
+
+        starter.kill()
+        db_start = time.time()
         self.db.set_faults(self.name, faults)
+        db_time = time.time() - db_start
         self._set_critical(critical.values())
+        self.last_faults = faults
+        self._save_state(faults)
+
+        if self.self_metrics:
+            metrics.extend((
+                (self.name + '#checks-run', len(checklets), ''),
+                (self.name + '#checks-skipped',
+                 len(self.checks) - len(checklets), ''),
+                (self.name + '#checks-timed-out', timed_out, ''),
+                (self.name + '#alert-time', alert_time, 's'),
+                (self.name + '#set-faults-time', db_time, 's'),
+                (self.name + '#perform-time', time.time() - start, 's'),
+                ))
+            writes_saved = getattr(self.db, 'writes_saved', None)
+            if writes_saved is not None:
+                metrics.append(
+                    (self.name + '#writes-saved', writes_saved, ''))
+        if isinstance(self.metric, MetricQueue):
+            queue = self.metric
+            metrics.extend((
+                (self.name + '#metrics-queued', queue.queue.qsize(), ''),
+                (self.name + '#metrics-dropped', queue.dropped, ''),
+                ))
+        if metrics:
+            timestamp = datetime.datetime.utcfromtimestamp(
+                time.time()).isoformat()
+            for name, value, units in metrics:
+                self.metric(timestamp=timestamp, name=name, value=value,
+                            units=units)
+
+        flush = getattr(self.metric, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def _perform(self, check, runtimes):
+        start = time.time()
+        result = check.perform()
+        runtimes[check.name] = time.time() - start
+        return result
+
+    def _start(self, pool, checklets):
+        for checklet in checklets:
+            pool.wait_available()
+            pool.start(checklet)
+
+    alert_slots = alert_limiter = None
+
+    def _alert(self, func):
+        """Spawn a greenlet to send an alert
+
+        Limiting the number of alerts sent at once and the rate at
+        which they're sent, if the agent is configured to.
+        """
+        def alert():
+            slots = self.alert_slots
+            if slots is not None:
+                slots.acquire()
+            try:
+                if self.alert_limiter is not None:
+                    self.alert_limiter.wait()
+                return func()
+            finally:
+                if slots is not None:
+                    slots.release()
+
+        return gevent.spawn(alert)
+
+    def _flush_alerts(self, flush, deadline):
+        """Call the alerter's flush method, returning whether it succeeded
+        """
+        flusher = gevent.spawn(flush)
+        flusher.join(max(deadline - time.time(), 0.0))
+        if flusher.successful():
+            return True
+        exception = flusher.exception
+        if exception is None:
+            flusher.kill(block=False)
+            if self.defer_alerts:
+                logger.warning("Alert flush deferred")
+                return True
+        logger.error("Alert flush failed: %s",
+                     "timeout" if exception is None else
+                     "%s: %s" % (exception.__class__.__name__, exception))
+        return False
 
     def trigger(self, fault):
 
@@ -181,10 +522,14 @@ class Agent:
             fault['triggered'] = 'y' # DynamoDB does odd things with booleans
             return 1
 
-        return gevent.spawn(trigger)
+        return self._alert(trigger)
 
     def resolve(self, name):
-        return gevent.spawn(lambda : [self.alerter.resolve(name)])
+        alert = self._alert(lambda : [self.alerter.resolve(name)])
+        alert.resolving = name
+        return alert
+
+    offset = 0.0
 
     def loop(self, count=-1):
         base_interval = self.base_interval
@@ -194,7 +539,7 @@ class Agent:
             if now - last > base_interval:
                 self.slow = True
             last = now
-            tick = now / base_interval
+            tick = (now - self.offset) / base_interval
             itick = int(tick)
             gevent.sleep(base_interval * (1 - (tick - itick)))
             try:
@@ -210,6 +555,14 @@ class Agent:
         del self.db
         # Remove this agent from the db:
         db.remove_agent(self.name)
+        # Keep saved state, but note that it's not in the db anymore:
+        self._save_state(self.last_faults, removed=True)
+        # Stop plugins:
+        for check in self.checks:
+            check.stop()
+        # Send queued metrics:
+        if isinstance(self.metric, MetricQueue):
+            self.metric.drain(self.alert_timeout)
         # And done:
         sys.exit(0)
 
@@ -219,20 +572,129 @@ class Agent:
     def metric(self, name, value, units, timestamp):
         pass
 
+class RateLimiter:
+    """Token bucket limiting how often something happens
+
+    On average, ``wait`` returns at most ``rate`` times per second,
+    although it can return ``burst`` times at once after a period of
+    inactivity.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = self.tokens = burst
+        self.updated = time.time()
+
+    def wait(self):
+        while 1:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            gevent.sleep((1 - self.tokens) / self.rate)
+
+class MetricQueue:
+    """Queue metrics to be sent to a metrics handler by a separate greenlet
+
+    This keeps slow metrics handlers from delaying checks.  If the
+    queue is full, metrics are dropped and counted.
+
+    Batches are passed to the handler in gevent's thread pool, so
+    handlers that block, like the Kinesis handler, which uses boto,
+    don't block the agent.  Handlers are called by one thread at a
+    time.
+
+    If the handler has an ``emit_many`` method, it's passed batches of
+    metrics. If it has a ``flush`` method, it's called whenever the
+    queue is emptied.
+    """
+
+    dropped = 0
+    batch_size = 500
+
+    def __init__(self, handler, size):
+        self.handler = handler
+        self.queue = gevent.queue.Queue(size)
+        self.lock = threading.Lock()
+        self.greenlet = gevent.spawn(self.run)
+
+    def __call__(self, **metric):
+        try:
+            self.queue.put_nowait(metric)
+        except gevent.queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            self.send([self.queue.get()])
+
+    def send(self, metrics):
+        queue = self.queue
+        while len(metrics) < self.batch_size and not queue.empty():
+            metrics.append(queue.get_nowait())
+        self.emit(metrics, queue.empty())
+
+    def emit(self, metrics, flush):
+        try:
+            zc.cimaa.util.threadpool_apply(
+                self._emit, self.handler, metrics, flush)
+        except Exception:
+            logger.exception("Sending metrics")
+
+    def _emit(self, handler, metrics, flush):
+        # Called in a thread
+        with self.lock:
+            emit_many = getattr(handler, 'emit_many', None)
+            if emit_many is None:
+                for metric in metrics:
+                    handler(**metric)
+            elif metrics:
+                emit_many(metrics)
+            if flush:
+                flush = getattr(handler, 'flush', None)
+                if flush is not None:
+                    flush()
+
+    def drain(self, timeout):
+        """Stop the sending greenlet and send queued metrics
+
+        Give up if sending takes longer than the timeout.
+        """
+        self.greenlet.kill()
+        with gevent.Timeout(timeout, False):
+            while not self.queue.empty():
+                self.send([])
+            self.emit([], True)
+
 class Check:
 
     failures = 0
     last_check = 0
+    priority = 0
+    is_global = False
+    phase = 0
+    returncode = None # Of the last command run
     def __init__(self, name, config):
         self.name = name
-        self.command = config['command']
         self.interval = int(config.get('interval', 1))
+        self.priority = int(config.get('priority', 0))
         self.retry = int(config.get('retry', 3))
         self.chances = self.retry + 1
         self.retry_interval = int(config.get('retry_interval', 1))
+        self.is_global = config.get('global', 'false').lower() == 'true'
         if 'thresholds' in config:
             self.thresholds = zc.cimaa.threshold.Thresholds(
                 config['thresholds'])
+        self.configure(config)
+
+    def configure(self, config):
+        """Handle options specific to the type of check
+        """
+        self.configure_command(config)
+        self.max_output = int(config.get('max_output', 1 << 20))
         parse = True
         if 'nagios_performance' in config:
             parse = config['nagios_performance'].lower()
@@ -250,7 +712,42 @@ class Check:
                     % config['nagios_performance'])
         self.parse_nagios = parse
 
+    def configure_command(self, config):
+        """Decide whether the command needs a shell
+
+        If it doesn't, split it into arguments and find the program,
+        so it can be run directly.
+        """
+        self.command = command = config['command']
+        shell = config.get('shell', '').lower()
+        if shell not in ('', 'true', 'false'):
+            raise zc.cimaa.parser.Error('bad value for shell: %r' % shell)
+        self.argv = None
+        if shell == 'true' or (not shell and needs_shell(command)):
+            return
+        try:
+            argv = shlex.split(command)
+        except ValueError, v:
+            raise zc.cimaa.parser.Error('bad command %r: %s' % (command, v))
+        if not argv:
+            return
+        program = find_program(argv[0])
+        if program is None:
+            logger.warning("%s: %r not found", self.name, argv[0])
+            if not shell:
+                return # Maybe it's a shell builtin.
+        else:
+            argv[0] = program
+        self.argv = argv
+
+    def popen(self, **kw):
+        if self.argv is None:
+            return gevent.subprocess.Popen(self.command, shell=True, **kw)
+        else:
+            return gevent.subprocess.Popen(self.argv, **kw)
+
     def should_run(self, minute):
+        minute -= self.phase
         interval = self.interval
         if self.failures:
             retry_interval = self.retry_interval
@@ -263,65 +760,23 @@ class Check:
 
         return minute % interval == 0
 
+    def start_order(self):
+        """Sort key deciding which due checks get started first
+
+        Higher-priority checks go first and, within a priority, checks
+        that are retrying after failures go first, since they're
+        closest to alerting.
+        """
+        return -self.priority, -self.failures
+
     def perform(self):
+        self.returncode = None
         try:
-            proc = gevent.subprocess.Popen(
-                self.command,
-                stdout=gevent.subprocess.PIPE,
-                stderr=gevent.subprocess.PIPE,
-                shell=True)
-            try:
-                stdout, stderr = proc.communicate()
-            except gevent.GreenletExit:
-                proc.kill()
-                raise
-
-            status = proc.returncode
+            result = self.run()
             now = time.time()
 
-            if status == 0 and stdout.startswith('{'):
-                try:
-                    result = json.loads(stdout)
-                    for f in result['faults']:
-                        if isinstance(f['severity'], basestring):
-                            f['severity'] = severity_names[
-                                f['severity'].lower()]
-                        f['message']
-                except Exception, v:
-                    logger.exception("Bad json response for %s", self.name)
-                    result = dict(faults=[dict(
-                        name='json-error',
-                        message = "%s: %s" % (v.__class__.__name__, v),
-                        severity = logging.ERROR,
-                        )])
-                faults = result['faults']
-            else:
-                faults = []
-                result = dict(faults=faults)
-
-                if stderr:
-                    faults.append(monitor_error("stderr", stderr))
-
-                if self.parse_nagios and stdout:
-                    stdout, result['metrics'] = (
-                        zc.cimaa.nagiosperf.parse_output(stdout))
-                if not stdout:
-                    faults.append(monitor_error("no-out"))
-                    stdout = "(no output)"
-                if len(stdout) > 200:
-                    stdout = stdout[:200]+' ...'
-
-                if status < 4:
-                    if status:
-                        faults.append(dict(severity=status_codes[status],
-                                           message=stdout))
-                else:
-                    faults.append(monitor_error("status", stdout))
-                    status = logging.ERROR
-
-
             self.thresholds(result)
-            for f in faults:
+            for f in result['faults']:
                 f['updated'] = now
 
             for m in result.get("metrics", ()):
@@ -342,6 +797,82 @@ class Check:
                 updated = time.time(),
                 )])
 
+    def run(self):
+        """Run the check, returning a result with faults and metrics
+
+        Thresholds, retries and timestamps are handled by ``perform``.
+        """
+        proc = self.popen(stdout=gevent.subprocess.PIPE,
+                          stderr=gevent.subprocess.PIPE)
+        errors = gevent.spawn(read_output, proc.stderr, self.max_output)
+        try:
+            stdout, truncated, parsed = read_output(
+                proc.stdout, self.max_output, self.parse_nagios)
+            stderr, stderr_truncated, _ = errors.get()
+            proc.wait()
+        except gevent.GreenletExit:
+            errors.kill(block=False)
+            proc.kill()
+            raise
+
+        status = self.returncode = proc.returncode
+
+        if status == 0 and stdout.startswith('{'):
+            result = self.parse_json(stdout)
+        else:
+            faults = []
+            result = dict(faults=faults)
+
+            if stderr:
+                faults.append(monitor_error("stderr", stderr))
+
+            if parsed is not None:
+                stdout, result['metrics'] = parsed
+            elif self.parse_nagios and stdout:
+                stdout, result['metrics'] = (
+                    zc.cimaa.nagiosperf.parse_output(stdout))
+            if not stdout:
+                faults.append(monitor_error("no-out"))
+                stdout = "(no output)"
+            if len(stdout) > 200:
+                stdout = stdout[:200]+' ...'
+
+            if status < 4:
+                if status:
+                    faults.append(dict(severity=status_codes[status],
+                                       message=stdout))
+            else:
+                faults.append(monitor_error("status", stdout))
+                status = logging.ERROR
+
+        if truncated or stderr_truncated:
+            result['faults'].append(monitor_error(
+                "output-truncated",
+                "output exceeded %s bytes" % self.max_output))
+
+        return result
+
+    def parse_json(self, output):
+        try:
+            result = json.loads(output)
+            for f in result['faults']:
+                if isinstance(f['severity'], basestring):
+                    f['severity'] = severity_names[
+                        f['severity'].lower()]
+                f['message']
+        except Exception, v:
+            logger.exception("Bad json response for %s", self.name)
+            result = dict(faults=[dict(
+                name='json-error',
+                message = "%s: %s" % (v.__class__.__name__, v),
+                severity = logging.ERROR,
+                )])
+        return result
+
+    def stop(self):
+        """Release any resources held between runs
+        """
+
     def check_critical(self, faults):
         """handle soft errors
 
@@ -411,8 +942,68 @@ class Check:
         pass
 
 
+class PersistentCheck(Check):
+    """Check that talks to a long-running plugin process
+
+    The plugin is started once.  Each time the check is performed, a
+    JSON request line is written to the plugin's standard input and
+    a line containing a JSON result, in the same format that other
+    plugins output, is read from its standard output.  If the plugin
+    exits or doesn't respond in time, it's restarted the next time
+    the check is performed.  Lines written to standard error are
+    logged.
+    """
+
+    proc = None
+
+    def configure(self, config):
+        self.configure_command(config)
+
+    def start(self):
+        self.proc = proc = self.popen(stdin=gevent.subprocess.PIPE,
+                                      stdout=gevent.subprocess.PIPE,
+                                      stderr=gevent.subprocess.PIPE)
+        gevent.spawn(self._log_stderr, proc)
+
+    def _log_stderr(self, proc):
+        for line in iter(proc.stderr.readline, ''):
+            logger.warning("%s: %s", self.name, line.rstrip())
+
+    def stop(self):
+        proc = self.proc
+        if proc is not None:
+            self.proc = None
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+    def run(self):
+        if self.proc is None or self.proc.poll() is not None:
+            self.stop()
+            self.start()
+        proc = self.proc
+        try:
+            proc.stdin.write(json.dumps(dict(name=self.name)) + '\n')
+            proc.stdin.flush()
+            line = proc.stdout.readline()
+        except gevent.GreenletExit:
+            # We don't know what state the plugin is in, so start over:
+            self.stop()
+            raise
+        except IOError:
+            line = ''
+
+        if not line:
+            self.stop()
+            return dict(faults=[monitor_error(
+                'exited', "plugin exited with status %s" % proc.returncode)])
+
+        return self.parse_json(line)
+
+
 class BadCheck(Check):
 
+    interval = 1
     retry = 0
     chances = 1
 
@@ -438,6 +1029,100 @@ severity_names = dict(warning=logging.WARNING,
                       error=logging.ERROR,
                       critical=logging.CRITICAL)
 
+# Characters that mean a command needs a shell. (Quotes and
+# backslashes are handled by shlex.)
+needs_shell = re.compile(r"[|&;<>()$`*?[\]{}~#!\n]|^\s*\w+=").search
+
+# Programs found on the PATH, by name:
+programs = {}
+
+def find_program(name):
+    """Return the path of an executable, or None if it can't be found
+
+    Programs found on the PATH are cached.
+    """
+    if os.path.dirname(name):
+        if os.path.isfile(name) and os.access(name, os.X_OK):
+            return name
+        return None
+    try:
+        return programs[name]
+    except KeyError:
+        pass
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            programs[name] = path
+            return path
+
+def read_output(pipe, limit, parse_nagios=False, chunk_size=1 << 16):
+    """Read output from a pipe, keeping at most ``limit`` bytes
+
+    Return the output kept, whether any was discarded and, if output
+    was discarded and ``parse_nagios`` is true, the text and metrics
+    parsed incrementally from all of the output.
+    """
+    output = []
+    size = 0
+    truncated = False
+    parser = None
+    while 1:
+        data = pipe.read(chunk_size)
+        if not data:
+            break
+        if parser is not None:
+            parser.feed(data)
+        if truncated:
+            continue # Discard the rest
+        output.append(data)
+        size += len(data)
+        if size > limit:
+            truncated = True
+            output = ''.join(output)
+            if parse_nagios:
+                parser = zc.cimaa.nagiosperf.Parser(limit)
+                parser.feed(output)
+            output = [output[:limit]]
+
+    return (''.join(output), truncated,
+            parser.close() if parser is not None else None)
+
+check_types = dict(
+    http='zc.cimaa.netcheck:HTTPCheck',
+    meta='zc.cimaa.meta:MetaCheck',
+    monitor='zc.cimaa.netcheck:MonitorCheck',
+    persistent='zc.cimaa.agent:PersistentCheck',
+    tcp='zc.cimaa.netcheck:TCPCheck',
+    unix='zc.cimaa.netcheck:UnixCheck',
+    )
+
+def check_class(config):
+    """Return the class implementing a check's ``type``
+
+    The type is either one of the names in ``check_types`` or a
+    ``module:name`` global name.  Checks without a type run commands.
+    """
+    type_ = config.get('type', 'command')
+    if type_ == 'command':
+        return Check
+    type_ = check_types.get(type_, type_)
+    if ':' not in type_:
+        raise zc.cimaa.parser.Error('unknown check type: %r' % type_)
+    mod, name = type_.split(':')
+    try:
+        mod = __import__(mod, {}, {}, [name])
+        return getattr(mod, name)
+    except (ImportError, AttributeError):
+        raise zc.cimaa.parser.Error('unknown check type: %r' % type_)
+
+def spread(*names):
+    """Return a number in [0, 1) computed from the given names
+
+    This is used to spread work over time in a way that's stable
+    across restarts and that differs from agent to agent.
+    """
+    return int(hashlib.md5('/'.join(names)).hexdigest()[:8], 16) / 2.0**32
+
 def monitor_error(name, message='', prefix='', severity=logging.ERROR):
     return dict(
         escalates=False,
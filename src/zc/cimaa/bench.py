@@ -0,0 +1,189 @@
+"""Micro-benchmarks
+
+These aren't run as part of the tests, except for smoke tests with
+tiny sizes.  Run them with::
+
+  python -m zc.cimaa.bench NAME
+
+where NAME is the name of one of the benchmark functions below.
+"""
+import re
+import sys
+import time
+
+def timed(func, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def squelches(sizes=(10, 100, 1000), faults=100):
+    """Compare searching squelches one at a time with a Matcher
+    """
+    import zc.cimaa.squelch
+
+    names = ['//host%s.example.com/app%s/check' % (i, i % 7)
+             for i in range(faults)]
+    print '%10s %12s %12s' % ('squelches', 're.search', 'Matcher')
+    for size in sizes:
+        patterns = sorted('^//host%s[.]example' % (faults + i)
+                          for i in range(size))
+
+        def search():
+            for name in names:
+                for squelch in patterns:
+                    if re.search(squelch, name):
+                        break
+
+        matcher = zc.cimaa.squelch.Matcher()
+        def match():
+            matcher.update(patterns)
+            for name in names:
+                matcher.match(name)
+
+        print '%10s %12.6f %12.6f' % (size, timed(search), timed(match))
+
+def cpu(func, repeat=3):
+    """Return the least CPU time, including that of child processes
+    """
+    import os
+    best = None
+    for i in range(repeat):
+        start = os.times()
+        func()
+        elapsed = sum(os.times()[:4]) - sum(start[:4])
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def commands(count=100, command='true'):
+    """Compare performing trivial command checks with and without a shell
+    """
+    import gevent
+    import zc.cimaa.agent
+
+    print '%10s %12s %12s' % ('checks', 'shell', 'direct')
+    def perform(shell):
+        checks = [zc.cimaa.agent.Check('check%s' % i,
+                                       dict(command=command, shell=shell))
+                  for i in range(count)]
+        return lambda: gevent.joinall([gevent.spawn(check.perform)
+                                       for check in checks])
+
+    print '%10s %12.6f %12.6f' % (
+        count, cpu(perform('true')), cpu(perform('false')))
+
+def thresholds(metrics=500, thresholds=50):
+    """Compare scanning metrics for each threshold with using an index
+    """
+    import zc.cimaa.threshold
+
+    results = dict(faults=[], metrics=[
+        dict(name='metric%s' % i, value=float(i)) for i in range(metrics)])
+    definition = '\n'.join(
+        'metric%s warning > %s error > %s' % (i * 7, i * 8, i * 9)
+        for i in range(thresholds))
+    indexed = zc.cimaa.threshold.Thresholds(definition)
+
+    def scan():
+        for threshold in indexed.thresholds:
+            v = [m for m in results['metrics'] if m['name'] == threshold.name]
+            if v:
+                threshold.check_value(threshold.name, v[0]['value'])
+
+    def index():
+        del results['faults'][:]
+        indexed(results)
+
+    print '%10s %10s %12s %12s' % ('metrics', 'thresholds', 'scan', 'index')
+    print '%10s %10s %12.6f %12.6f' % (
+        metrics, thresholds, timed(scan), timed(index))
+
+def fleet(agents=5000, faults=5, path=None):
+    """Time a simulated fleet of agents setting faults in a MemoryDB
+
+    After the first round, 1% of the agents stop, so there are old
+    agents to find.  If a path is given, the database is saved to a
+    SQLite file there.
+    """
+    import zc.cimaa.stub
+
+    config = dict(path=path) if path else {}
+    db = zc.cimaa.stub.MemoryDB(config)
+    names = ['agent%s.example.com' % i for i in range(agents)]
+    tick = [time.time() - 3600]
+
+    def set_faults():
+        tick[0] += 60
+        for i, name in enumerate(names):
+            if i % 100 or name not in db.agents:
+                db.set_faults(name, [
+                    dict(name='fault%s' % f, severity=40, message='bad',
+                         updated=tick[0])
+                    for f in range(faults)], tick[0])
+
+    def old_agents():
+        for i in range(100):
+            old = db.old_agents(time.time() - tick[0] + 30)
+        assert len(old) == (agents + 99) // 100
+
+    print '%10s %10s %12s %12s' % (
+        'agents', 'faults', 'set_faults', 'old_agents')
+    print '%10s %10s %12.6f %12.6f' % (
+        agents, faults, timed(set_faults), timed(old_agents) / 100)
+    db.close()
+
+def databases(ticks=20, faults=5, latency=.01):
+    """Compare agent tick database latency for SQLite and DynamoDB
+
+    Each tick, an agent sets its faults and gets squelches.  DynamoDB
+    is simulated by an in-memory stand-in whose requests take
+    ``latency`` seconds.
+    """
+    import os
+    import shutil
+    import tempfile
+    import zc.cimaa.dynamodb
+    import zc.cimaa.sqlite
+    import zc.cimaa.stub
+
+    def tick(db):
+        def tick():
+            for i in range(ticks):
+                db.set_faults('agent', [
+                    dict(name='fault%s' % f, severity=40, message='bad',
+                         updated=time.time())
+                    for f in range(faults)])
+                db.get_squelches()
+        return tick
+
+    directory = tempfile.mkdtemp()
+    try:
+        sqlite = zc.cimaa.sqlite.DB(
+            dict(path=os.path.join(directory, 'cimaa.db')))
+        sqlite_time = timed(tick(sqlite)) / ticks
+        sqlite.close()
+    finally:
+        shutil.rmtree(directory)
+
+    class Table(zc.cimaa.stub.LocalTable):
+        pass
+    Table.latency = latency
+    connect, table = zc.cimaa.dynamodb.connect, zc.cimaa.dynamodb.table
+    zc.cimaa.dynamodb.connect = lambda config: (None, 'bench.')
+    zc.cimaa.dynamodb.table = Table
+    try:
+        dynamodb = zc.cimaa.dynamodb.DB({})
+    finally:
+        zc.cimaa.dynamodb.connect, zc.cimaa.dynamodb.table = connect, table
+    dynamodb_time = timed(tick(dynamodb)) / ticks
+
+    print '%10s %12s %12s' % ('faults', 'sqlite', 'dynamodb')
+    print '%10s %12.6f %12.6f' % (faults, sqlite_time, dynamodb_time)
+
+if __name__ == '__main__':
+    globals()[sys.argv[1]]()
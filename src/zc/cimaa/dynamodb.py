@@ -5,16 +5,32 @@ import boto.dynamodb2.exceptions
 import boto.dynamodb2.fields
 import boto.dynamodb2.table
 import boto.dynamodb2.types
+import gevent
 import logging
 import random
 import sys
 import time
+import uuid
 import zc.cimaa.parser
+import zc.cimaa.util
+import zlib
 
 
 READ_ATTEMPTS = 5
 WRITE_ATTEMPTS = 3
 
+# Key of a squelch-table item that's updated whenever squelches
+# change.  It's not a valid regular expression, so it can't be
+# confused with a squelch.
+SQUELCH_VERSION = u'*version'
+
+# Faults-table hash key of unsharded agent heartbeats.  With
+# heartbeat_buckets, heartbeats are stored under '_0', '_1', ...
+HEARTBEAT = u'_'
+
+# Faults-table hash key of leases.
+LEASE = u'*lease'
+
 logger = logging.getLogger(__name__)
 
 schemas = dict(
@@ -38,18 +54,107 @@ schemas = dict(
 
 class DB:
 
+    squelch_cache_hits = squelch_cache_misses = 0
+    _squelch_cache = None # (version, squelches, checked)
+    _squelch_details_cache = None # (version, details, checked)
+    writes_saved = total_writes_saved = 0
+
     def __init__(self, config, tables=tuple(schemas)):
         # {agent: {name: fault_data}}
         self.last_faults = {}
+        # {agent: {name: number of times a write was skipped}}
+        self.skipped = {}
+        self.squelch_ttl = float(config.get('squelch_ttl', 0))
+        self.delta_writes = (
+            config.get('delta_writes', 'false').lower() == 'true')
+        self.delta_refresh = int(config.get('delta_refresh', 0))
+        self.heartbeat_buckets = int(config.get('heartbeat_buckets', 0))
+        self.legacy_heartbeats = (
+            config.get('legacy_heartbeats', 'true').lower() == 'true')
+        # Agents whose legacy heartbeats we've deleted
+        self.migrated = set()
         conn, prefix = connect(config)
         for name in schemas:
             setattr(self, name, table(conn, prefix, name))
 
+    def heartbeat_key(self, agent):
+        """Return the hash key of an agent's heartbeat
+        """
+        if not self.heartbeat_buckets:
+            return HEARTBEAT
+        if isinstance(agent, unicode):
+            agent = agent.encode('utf-8')
+        return u'%s%d' % (
+            HEARTBEAT, (zlib.crc32(agent) & 0xffffffff) % self.heartbeat_buckets)
+
+    def heartbeat_keys(self):
+        """Return the hash keys heartbeats may be stored under
+        """
+        keys = [u'%s%d' % (HEARTBEAT, bucket)
+                for bucket in range(self.heartbeat_buckets)]
+        if self.legacy_heartbeats or not keys:
+            keys.append(HEARTBEAT)
+        return keys
+
     def old_agents(self, age):
+        """Return agents whose heartbeats are older than age seconds
+
+        Heartbeat buckets are queried concurrently, in threads, as
+        boto doesn't cooperate with gevent without monkey-patching.
+        """
         max_updated = time.time() - age
-        return [dict(name=i['name'], updated=int(i['updated']))
-                for i in self.faults.query_2(
-                    index='updated', agent__eq='_', updated__lt=max_updated)]
+
+        def query(key):
+            @retry(READ_ATTEMPTS, "reading heartbeats")
+            def items():
+                return [(i['name'], int(i['updated']))
+                        for i in self.faults.query_2(
+                            index='updated', agent__eq=key,
+                            updated__lt=max_updated)]
+            return items
+
+        keys = self.heartbeat_keys()
+        if len(keys) == 1:
+            results = [query(keys[0])]
+        else:
+            greenlets = [
+                gevent.spawn(zc.cimaa.util.threadpool_apply, query, key)
+                for key in keys]
+            # Let all queries finish, even if some fail:
+            gevent.joinall(greenlets)
+            results = [greenlet.get() for greenlet in greenlets]
+
+        # During migration, an agent may have heartbeats in its bucket
+        # and in the legacy key.  Use the newest.
+        agents = {}
+        for items in results:
+            for name, updated in items:
+                agents[name] = max(updated, agents.get(name, updated))
+        return [dict(name=name, updated=updated)
+                for name, updated in sorted(agents.items())]
+
+    def migrate_heartbeats(self):
+        """Move legacy heartbeats to heartbeat buckets
+
+        Agents using heartbeat buckets remove their legacy heartbeats,
+        but heartbeats of agents that have stopped are left behind.
+        Call this once all agents use buckets, and then set
+        ``legacy_heartbeats`` to false.  Returns the number of
+        heartbeats moved.
+        """
+        if not self.heartbeat_buckets:
+            raise ValueError("heartbeat_buckets isn't set")
+        items = list(self.faults.query_2(agent__eq=HEARTBEAT))
+        with self.faults.batch_write() as batch:
+            for item in items:
+                name = item['name']
+                batch.put_item(dict(
+                    agent=self.heartbeat_key(name),
+                    name=name,
+                    updated=int(item['updated']),
+                    ), overwrite=True)
+                batch.delete_item(agent=HEARTBEAT, name=name)
+        return len(items)
 
     def get_faults(self, agent):
         @retry(READ_ATTEMPTS, "reading")
@@ -67,35 +172,62 @@ class DB:
             old_faults = self.last_faults.get(agent)
 
         @retry(WRITE_ATTEMPTS, "writing")
-        def write_faults():
-            self._set_faults(agent, faults, old_faults)
+        def written():
+            return self._set_faults(agent, faults, old_faults)
 
-        self.last_faults[agent] = {fault['name']: fault for fault in faults}
+        self.last_faults[agent] = written
+
+    def restore_faults(self, agent, faults):
+        self.last_faults[agent] = dict(
+            (fault['name'], dict(fault, agent=agent)) for fault in faults)
 
     def _set_faults(self, agent, faults, old_faults):
+        """Write faults, returning {name: data} for the data written
+
+        In delta mode, faults that haven't changed (except for their
+        update times) aren't written, unless they've been skipped
+        delta_refresh times.  The agent heartbeat is always written.
+        """
         now = int(time.time())
+        written = {}
+        old_skipped = self.skipped.get(agent, {})
+        skipped = {}
         with self.faults.batch_write() as batch:
             # Heartbeat
+            key = self.heartbeat_key(agent)
             batch.put_item(dict(
-                agent='_',
+                agent=key,
                 name=agent,
                 updated=now,
                 ))
+            if key != HEARTBEAT and agent not in self.migrated:
+                batch.delete_item(agent=HEARTBEAT, name=agent)
+                self.migrated.add(agent)
 
             for fault in faults:
                 data = fault.copy()
                 data['agent'] = agent
                 name = fault['name']
-                if name in old_faults:
-                    if 'since' not in old_faults[name]:
-                        old_faults[name]['since'] = now
-                    data['since'] = old_faults[name]['since']
-                    del old_faults[name]
-                else:
-                    data['since'] = now
+                old = old_faults.get(name)
+                since = now if old is None else old.get('since', now)
+                fault['since'] = data['since'] = since
+                if (old is not None and self.delta_writes and
+                    _unchanged(old, data)):
+                    nskipped = old_skipped.get(name, 0)
+                    if not self.delta_refresh or nskipped < self.delta_refresh:
+                        written[name] = old
+                        skipped[name] = nskipped + 1
+                        continue
                 batch.put_item(data, overwrite=True)
+                written[name] = data
             for name in old_faults:
-                batch.delete_item(agent=agent, name=name)
+                if name not in written:
+                    batch.delete_item(agent=agent, name=name)
+
+        self.skipped[agent] = skipped
+        self.writes_saved = len(skipped)
+        self.total_writes_saved += self.writes_saved
+        return written
 
     def get_squelch(self, regex):
         try:
@@ -105,12 +237,61 @@ class DB:
         return _squelch_data(item)
 
     def get_squelches(self):
+        return self._cached('_squelch_cache', self._scan_squelches)
+
+    def _cached(self, cache_name, scan):
+        """Return squelch data, scanning only if squelches have changed
+
+        The data are cached in the named attribute.
+        """
+        if not self.squelch_ttl:
+            return scan()
+
+        now = time.time()
+        cache = getattr(self, cache_name)
+        if cache is not None:
+            cached_version, squelches, checked = cache
+            if now - checked < self.squelch_ttl:
+                self.squelch_cache_hits += 1
+                return squelches
+
+        version = self._squelch_version()
+        if (cache is not None and version is not None and
+            version == cached_version):
+            self.squelch_cache_hits += 1
+            setattr(self, cache_name, (version, squelches, now))
+            return squelches
+
+        self.squelch_cache_misses += 1
+        squelches = scan()
+        setattr(self, cache_name, (version, squelches, now))
+        return squelches
+
+    def _squelch_version(self):
+        try:
+            return self.squelches.lookup(SQUELCH_VERSION)['version']
+        except boto.dynamodb2.exceptions.ItemNotFound:
+            return None
+
+    def _scan_squelches(self):
         return sorted(item['regex']
                       for item in self.squelches.scan(attributes=['regex'])
+                      if item['regex'] != SQUELCH_VERSION
                       )
 
+    def _squelches_changed(self):
+        self.squelches.put_item(
+            dict(regex=SQUELCH_VERSION, version=uuid.uuid4().hex),
+            overwrite=True)
+        self._squelch_cache = self._squelch_details_cache = None
+
     def get_squelch_details(self):
-        return sorted((_squelch_data(item) for item in self.squelches.scan()),
+        return self._cached('_squelch_details_cache',
+                            self._scan_squelch_details)
+
+    def _scan_squelch_details(self):
+        return sorted((_squelch_data(item) for item in self.squelches.scan()
+                       if item['regex'] != SQUELCH_VERSION),
                       key=_squelch_regex)
 
     def squelch(self, regex, reason, user, permanent=False):
@@ -120,9 +301,11 @@ class DB:
                                      permanent = 'p' if permanent else '',
                                      time=int(time.time()),
                                      ))
+        self._squelches_changed()
 
     def unsquelch(self, regex):
         self.squelches.delete_item(regex=regex)
+        self._squelches_changed()
 
     def remove_agent(self, agent):
         faults = self.last_faults.get(agent)
@@ -132,13 +315,44 @@ class DB:
 
         with self.faults.batch_write() as batch:
             # Heartbeat
-            batch.delete_item(agent='_', name=agent)
+            for key in set((HEARTBEAT, self.heartbeat_key(agent))):
+                batch.delete_item(agent=key, name=agent)
 
             for fault in faults:
                 batch.delete_item(agent=agent, name=fault)
 
         if agent in self.last_faults:
             del self.last_faults[agent]
+        self.skipped.pop(agent, None)
+        self.migrated.discard(agent)
+
+    def acquire_lease(self, name, holder, duration):
+        now = time.time()
+        try:
+            lease = self.faults.lookup(LEASE, name)
+        except boto.dynamodb2.exceptions.ItemNotFound:
+            pass
+        else:
+            # Don't spend a write when another agent holds the lease.
+            if lease['holder'] != holder and lease['expires'] > now:
+                return False
+
+        table = self.faults
+        try:
+            table.connection.put_item(
+                table.table_name,
+                table._encode_keys(dict(
+                    agent=LEASE, name=name, holder=holder,
+                    expires=now + duration)),
+                condition_expression=(
+                    'attribute_not_exists(expires) OR expires < :now'
+                    ' OR holder = :holder'),
+                expression_attribute_values=table._encode_keys({
+                    ':now': now, ':holder': holder}),
+                )
+        except boto.dynamodb2.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
 
     def dump(self, name=None):
         return dict(
@@ -148,10 +362,18 @@ class DB:
                 key=lambda item: (item['agent'], item['name'])),
             squelches = sorted(
                 (_squelch_data(dict(item.items()))
-                 for item in self.squelches.scan()),
+                 for item in self.squelches.scan()
+                 if item['regex'] != SQUELCH_VERSION),
                 key=lambda item: ['regex']),
             )
 
+# Fault data that change without the fault changing
+_volatile = (u'agent', u'since', u'updated')
+
+def _unchanged(old, new):
+    return (dict((k, v) for (k, v) in old.items() if k not in _volatile) ==
+            dict((k, v) for (k, v) in new.items() if k not in _volatile))
+
 def retry(attempts, doing_what):
     from boto.dynamodb2.exceptions import ProvisionedThroughputExceededException
 
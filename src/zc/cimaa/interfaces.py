@@ -58,6 +58,8 @@ class IDB(zope.interface.Interface):
         """Set current faults for an agent.
 
         See get_faults for a description of fault data.
+
+        The ``since`` item of the faults passed should be updated.
         """
 
     def get_squelches():
@@ -86,6 +88,28 @@ class IDB(zope.interface.Interface):
         of a termination procedure.
         """
 
+    # Optional methods:
+
+    def restore_faults(agent, faults):
+        """Tell the database what an agent's faults were last set to
+
+        Agents that save their state locally call it on startup
+        instead of calling get_faults, so databases that keep track of
+        previous faults can avoid reading them.
+        """
+
+    def acquire_lease(name, holder, duration):
+        """Try to acquire or renew a named lease
+
+        The holder is an agent name.  If the lease is free, has
+        expired, or is already held by the holder, it's given to the
+        holder for the next ``duration`` seconds and True is returned.
+        Otherwise, False is returned.  This must be atomic, for example,
+        using a conditional write.
+
+        Agents use a lease to decide which agent performs global checks.
+        """
+
 class IAlerter(zope.interface.Interface):
     """Interface for triggering and resolving alerts.
     """
@@ -105,9 +129,37 @@ class IAlerter(zope.interface.Interface):
     def resolve(self, name):
         "Resolve an alert with the given name(/id)"
 
+    # Optional methods:
+
+    def flush():
+        """Send any batched alerts
+
+        This is optional. If provided, it's called by the agent after
+        triggering and resolving alerts each interval, and is subject
+        to the alert timeout.
+        """
+
 class IMetrics(zope.interface.Interface):
     """Interface for handling metrics data
     """
 
     def __call__(timestamp, name, value, units=''):
         "Handle a single metric value"
+
+    # Optional methods:
+
+    def emit_many(metrics):
+        """Handle a sequence of metric values
+
+        Each metric is a dictionary with the arguments to ``__call__``.
+
+        This is optional. If provided, it's used when the agent sends
+        queued metrics.
+        """
+
+    def flush():
+        """Send any buffered metric values
+
+        This is optional. If provided, it's called by the agent at
+        the end of each interval, or after sending queued metrics.
+        """
@@ -1,5 +1,9 @@
 import json
 import boto.kinesis
+import logging
+import time
+
+logger = logging.getLogger(__name__)
 
 class Metrics:
 
@@ -21,3 +25,103 @@ class Metrics:
             self.explicit_hash_key,
             self._sn)['SequenceNumber']
 
+# PutRecords limits
+MAX_RECORDS = 500
+MAX_BYTES = 5 << 20
+
+class BatchMetrics:
+    """Metrics handler that buffers metrics and sends them in batches
+
+    Buffered metrics are sent using PutRecords when there are enough
+    for a full batch, when the oldest is older than ``max_age``
+    seconds, or when ``flush`` is called (by the agent, at the end of
+    each interval).
+
+    If sending fails, metrics are kept to be sent later, but at most
+    ``max_buffer`` metrics are kept. When the buffer is full, the
+    oldest metrics are dropped and counted.  After a failure, sending
+    isn't tried again, except by ``flush``, for ``max_age`` seconds,
+    so an outage doesn't cause a blocking request per metric.
+    """
+
+    dropped = 0
+    _oldest = None
+    _retry_after = 0
+
+    def __init__(self, config):
+        conn = boto.kinesis.connect_to_region(config['region'])
+        self._put = conn.put_record
+        self._put_records = conn.put_records
+        self.stream = config['stream']
+        self.partition_key = config.get('partition_key')
+        self.explicit_hash_key = config.get('explicit_hash_key')
+        self.batch_size = min(
+            int(config.get('batch_size', MAX_RECORDS)), MAX_RECORDS)
+        self.max_age = float(config.get('max_age', 60))
+        self.max_buffer = int(config.get('max_buffer', 10000))
+        self.buffer = []
+
+    def __call__(self, timestamp, name, value, units=''):
+        if len(self.buffer) >= self.max_buffer:
+            del self.buffer[0]
+            self.dropped += 1
+
+        record = dict(
+            Data=json.dumps(dict(
+                timestamp=timestamp, name=name, value=value, units=units)),
+            PartitionKey=self.partition_key or name,
+            )
+        if self.explicit_hash_key:
+            record['ExplicitHashKey'] = self.explicit_hash_key
+        self.buffer.append(record)
+
+        now = time.time()
+        if self._oldest is None:
+            self._oldest = now
+        if now < self._retry_after:
+            return
+        if (len(self.buffer) >= self.batch_size or
+            now - self._oldest >= self.max_age):
+            self.flush()
+
+    def emit_many(self, metrics):
+        for metric in metrics:
+            self(**metric)
+
+    def flush(self):
+        while self.buffer:
+            batch = []
+            size = 0
+            for record in self.buffer[:self.batch_size]:
+                rsize = len(record['Data']) + len(record['PartitionKey'])
+                if batch and size + rsize > MAX_BYTES:
+                    break
+                batch.append(record)
+                size += rsize
+
+            try:
+                result = self._put_records(
+                    [record.copy() for record in batch], self.stream)
+            except Exception:
+                logger.exception("Sending metrics to %s", self.stream)
+                # Keep the records and try again later:
+                self._oldest = time.time()
+                self._retry_after = self._oldest + self.max_age
+                return
+
+            del self.buffer[:len(batch)]
+            if result.get('FailedRecordCount'):
+                for record, rresult in zip(batch, result['Records']):
+                    if 'ErrorCode' in rresult:
+                        self._retry(record)
+
+        self._oldest = None
+        self._retry_after = 0
+
+    def _retry(self, record):
+        try:
+            self._put(self.stream, record['Data'], record['PartitionKey'],
+                      record.get('ExplicitHashKey'))
+        except Exception:
+            logger.exception("Sending metric to %s", self.stream)
+            self.dropped += 1
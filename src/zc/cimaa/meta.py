@@ -4,9 +4,60 @@ import logging
 import sys
 import time
 import urllib
+import zc.cimaa.agent
 import zc.cimaa.parser
+import zc.cimaa.util
 
-def main(args=None):
+class Monitor:
+    """Meta-monitor that can be run repeatedly
+
+    The database is loaded once and kept, along with any data it
+    caches, between runs.
+    """
+
+    def __init__(self, config, warn=2, error=5, global_squelch_age=60):
+        if isinstance(config, basestring):
+            config = zc.cimaa.parser.parse_file(config)
+        self.db = zc.cimaa.parser.load_handler(config['database'])
+        agent = config.get('agent', {})
+        base_interval = int(agent.get('base_interval', 60))
+
+        self.warn = warn * base_interval
+        self.error = error * base_interval
+        self.max_squelch = global_squelch_age * 60
+
+    def __call__(self):
+        db = self.db
+        faults = []
+        result = dict(faults=faults)
+        now = time.time()
+
+        # Check for inactive agents:
+        for agent in sorted(db.old_agents(self.warn), key=agent_name):
+            age = now - agent['updated']
+            faults.append(dict(
+                name=agent['name'],
+                message='Inactive agent',
+                severity=(logging.ERROR if age > self.error
+                          else logging.WARNING),
+                ))
+
+        # Check for forgotten global squelch
+        for squelch in db.get_squelch_details():
+            if squelch['permanent']:
+                continue
+            age = now - squelch['time']
+            if age > self.max_squelch:
+                faults.append(dict(
+                    name='squelch-' + urllib.quote(squelch['regex']),
+                    message=(
+                        'Alerts squelched %d minutes ago by %s because %s' % (
+                            age / 60, squelch['user'], squelch['reason'])),
+                    severity=logging.ERROR,
+                    ))
+        return result
+
+def main(args=None, stdin=None, stdout=None):
     if args is None:
         args = sys.argv[1:]
 
@@ -23,44 +74,60 @@ def main(args=None):
     parser.add_argument(
         '--global-squelch-age', '-s', type=int, default=60,
         help='Maximum age, in minutes, of global squelches')
+    parser.add_argument(
+        '--persistent', '-p', action='store_true',
+        help='Run as a persistent plugin, performing checks for each'
+        ' request line read from standard input')
 
     args = parser.parse_args(args)
-    config = zc.cimaa.parser.parse_file(args.configuration)
-    db = zc.cimaa.parser.load_handler(config['database'])
-    agent = config.get('agent', {})
-    base_interval = int(agent.get('base_interval', 60))
-
-    warn = args.warn * base_interval
-    error = args.error * base_interval
-    max_squelch = args.global_squelch_age * 60
-
-    faults = []
-    result = dict(faults=faults)
-    now = time.time()
-
-    # Check for inactive agents:
-    for agent in sorted(db.old_agents(warn), key=agent_name):
-        age = now - agent['updated']
-        faults.append(dict(
-            name=agent['name'],
-            message='Inactive agent',
-            severity=logging.ERROR if age > error else logging.WARNING,
-            ))
-
-    # Check for forgotten global squelch
-    old_squelches = []
-    for squelch in db.get_squelch_details():
-        if squelch['permanent']:
-            continue
-        age = now - squelch['time']
-        if age > max_squelch:
-            faults.append(dict(
-                name='squelch-' + urllib.quote(squelch['regex']),
-                message='Alerts squelched %d minutes ago by %s because %s' % (
-                    age / 60, squelch['user'], squelch['reason']),
+    monitor = Monitor(args.configuration,
+                      args.warn, args.error, args.global_squelch_age)
+    if not args.persistent:
+        print json.dumps(monitor())
+        return
+
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    for line in iter(stdin.readline, ''):
+        try:
+            result = monitor()
+        except Exception, v:
+            logging.getLogger(__name__).exception("meta-check failed")
+            result = dict(faults=[dict(
+                name='checker',
+                message="%s: %s" % (v.__class__.__name__, v),
                 severity=logging.ERROR,
-                ))
-    print json.dumps(result)
+                )])
+        stdout.write(json.dumps(result) + '\n')
+        stdout.flush()
+
+class MetaCheck(zc.cimaa.agent.Check):
+    """Meta-monitor check run in the agent
+
+    The ``configuration`` option names the configuration file defining
+    the database to check.  The ``warn``, ``error`` and
+    ``global_squelch_age`` options correspond to the ``meta-check``
+    script options.  The database is queried in a thread, so the
+    agent isn't blocked by database clients that don't use gevent.
+    """
+
+    monitor = None
+
+    def configure(self, config):
+        self.configuration = config.get('configuration')
+        if not self.configuration:
+            raise zc.cimaa.parser.Error('missing configuration option')
+        self.options = dict(
+            (name, int(config[name]))
+            for name in ('warn', 'error', 'global_squelch_age')
+            if name in config)
+
+    def run(self):
+        if self.monitor is None:
+            # Load the database when first needed, so problems
+            # loading it are reported as faults.
+            self.monitor = Monitor(self.configuration, **self.options)
+        return zc.cimaa.util.threadpool_apply(self.monitor)
 
 def agent_name(agent):
     return agent['name']
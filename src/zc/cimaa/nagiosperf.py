@@ -49,6 +49,55 @@ r"""Parser for nagios performance data
      [{'name': 'm', 'units': 'MB', 'value': 2643.0}])
 
 See: https://nagios-plugins.org/doc/guidelines.html#AEN200
+
+Output can also be parsed incrementally, keeping a limited amount of
+text and performance data.  This is useful for output that's too large
+to hold in memory.  Without a limit, the results are the same as for
+``parse_output``:
+
+    >>> def incremental(text, limit=None, size=3):
+    ...     parser = Parser(limit)
+    ...     for i in range(0, len(text), size):
+    ...         parser.feed(text[i:i+size])
+    ...     result = parser.close()
+    ...     assert result == parse_output(text), result
+    ...     return parser.truncated
+
+    >>> incremental("DISK OK - free space: / 3326 MB (56%);")
+    False
+    >>> incremental(
+    ... "DISK OK - free space: / 3326 MB (56%); | /=2643MB;5948;5958;0;5968")
+    False
+    >>> incremental(
+    ... '''DISK OK - free space: / 3326 MB (56%); | /=2643MB;5948;5958;0;5968
+    ... / 15272 MB (77%);
+    ... /boot 68 MB (69%); | /boot=68MB;88;93;0;98
+    ... /home=69357MB;253404;253409;0;253414 | x=1''')
+    False
+    >>> incremental("| 'ha ha ha'=3has")
+    False
+    >>> incremental("ok\nmore\n| x=1\n y=2", size=1)
+    False
+
+With a limit, text and performance data beyond the limit are
+discarded, and the ``truncated`` attribute is set:
+
+    >>> parser = Parser(20)
+    >>> parser.feed("DISK OK | a=1 b=2\n")
+    >>> for i in range(1000):
+    ...     parser.feed("lots and lots of text\n")
+    >>> parser.feed("| c=3MB d=4 e=5555555555555555555555 f=6")
+    >>> parser.truncated
+    True
+    >>> pprint.pprint(parser.close())
+    ('DISK OK \nlots and lot',
+     [{'name': 'a', 'units': '', 'value': 1.0},
+      {'name': 'b', 'units': '', 'value': 2.0},
+      {'name': 'c', 'units': 'MB', 'value': 3.0},
+      {'name': 'd', 'units': '', 'value': 4.0}])
+
+(Partial performance data, like the truncated ``e`` value above, is
+discarded.)
 """
 
 import re
@@ -74,3 +123,81 @@ def parse_output(text):
         [dict(name=m[0], value=float(m[1]), units=m[3])
          for m in perf_parse(perf)],
         )
+
+class Parser:
+    """Incremental output parser
+
+    Feed output with ``feed`` and get the text and metrics from
+    ``close``.  At most ``limit`` characters of text, and of
+    performance data, are kept.
+    """
+
+    truncated = False
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.first = []  # Text on the first line
+        self.text = []   # Long text
+        self.perf = []
+        self.sizes = dict(text=0, perf=0)
+        self.state = self.first_text
+
+    def feed(self, data):
+        while data:
+            data = self.state(data)
+
+    def keep(self, kind, pieces, data):
+        limit = self.limit
+        if limit is not None:
+            room = limit - self.sizes[kind]
+            if len(data) > room:
+                self.truncated = True
+                data = data[:max(room, 0)]
+        if data:
+            pieces.append(data)
+            self.sizes[kind] += len(data)
+
+    def first_text(self, data):
+        bar = data.find('|')
+        newline = data.find('\n')
+        if bar >= 0 and (newline < 0 or bar < newline):
+            self.keep('text', self.first, data[:bar])
+            self.state = self.first_perf
+            return data[bar+1:]
+        if newline >= 0:
+            self.keep('text', self.first, data[:newline])
+            self.state = self.long_text
+            return data[newline+1:]
+        self.keep('text', self.first, data)
+
+    def first_perf(self, data):
+        newline = data.find('\n')
+        if newline >= 0:
+            self.keep('perf', self.perf, data[:newline] + ' ')
+            self.state = self.long_text
+            return data[newline+1:]
+        self.keep('perf', self.perf, data)
+
+    def long_text(self, data):
+        bar = data.find('|')
+        if bar >= 0:
+            self.keep('text', self.text, data[:bar])
+            self.state = self.long_perf
+            return data[bar+1:]
+        self.keep('text', self.text, data)
+
+    def long_perf(self, data):
+        self.keep('perf', self.perf, data.replace('\n', ''))
+
+    def close(self):
+        if self.state == self.first_perf:
+            self.perf.append(' ')
+        perf = ''.join(self.perf)
+        if self.truncated and self.sizes['perf'] >= self.limit:
+            # Don't report a metric that may have been cut off:
+            perf = perf[:max(perf.rfind(' '), perf.rfind('\t'), 0)]
+        return (
+            ''.join(self.first) + '\n' + ''.join(self.text),
+            [dict(name=m[0], value=float(m[1]), units=m[3])
+             for m in perf_parse(perf)],
+            )
@@ -0,0 +1,243 @@
+"""Network checks that run in the agent rather than in a subprocess
+
+Select them with the ``type`` option of a check section.
+"""
+import gevent
+import gevent.socket
+import httplib
+import socket
+import time
+import urlparse
+
+import zc.cimaa.agent
+import zc.cimaa.parser
+
+class NetworkCheck(zc.cimaa.agent.Check):
+
+    def configure(self, config):
+        self.timeout = float(config.get('timeout', 10))
+        severity = config.get('severity', 'error').lower()
+        if severity not in zc.cimaa.agent.severity_names:
+            raise zc.cimaa.parser.Error('bad severity: %r' % severity)
+        self.severity = zc.cimaa.agent.severity_names[severity]
+        self.configure_network(config)
+
+    def configure_network(self, config):
+        """Configure the check from its configuration section
+        """
+
+    def run(self):
+        result = dict(faults=[], metrics=[])
+        start = time.time()
+        try:
+            with gevent.Timeout(self.timeout, socket.timeout('timed out')):
+                message = self.probe(result)
+        except (socket.error, httplib.HTTPException), v:
+            message = "%s: %s" % (
+                self.address,
+                getattr(v, 'strerror', None) or str(v) or
+                v.__class__.__name__)
+        else:
+            result['metrics'].insert(0, dict(
+                name='response-time', value=time.time() - start, units='s'))
+        if message:
+            result['faults'].append(
+                dict(severity=self.severity, message=message))
+        return result
+
+    def probe(self, result):
+        """Talk to the service
+
+        Return an error message, if there's a problem, and add any
+        faults and metrics beyond the response time to the result.
+        """
+
+def required(config, name):
+    try:
+        return config[name]
+    except KeyError:
+        raise zc.cimaa.parser.Error('missing %s option' % name)
+
+class TCPCheck(NetworkCheck):
+    """Check that we can connect to a host and port
+
+    The ``address`` option has the form ``HOST:PORT``.
+    """
+
+    def configure_network(self, config):
+        self.address = required(config, 'address')
+        try:
+            host, port = self.address.rsplit(':', 1)
+            self.host_port = host, int(port)
+        except ValueError:
+            raise zc.cimaa.parser.Error('bad address: %r' % self.address)
+
+    def probe(self, result):
+        gevent.socket.create_connection(self.host_port, self.timeout).close()
+
+class UnixCheck(NetworkCheck):
+    """Check that we can connect to a unix-domain socket
+
+    The ``address`` option is the path of the socket.
+    """
+
+    def configure_network(self, config):
+        self.address = required(config, 'address')
+
+    def probe(self, result):
+        sock = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+        finally:
+            sock.close()
+
+class HTTPConnection(httplib.HTTPConnection):
+
+    def connect(self):
+        self.sock = gevent.socket.create_connection(
+            (self.host, self.port), self.timeout)
+
+class HTTPSConnection(httplib.HTTPSConnection):
+
+    def connect(self):
+        import gevent.ssl
+        self.sock = gevent.ssl.wrap_socket(
+            gevent.socket.create_connection(
+                (self.host, self.port), self.timeout),
+            self.key_file, self.cert_file)
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, socket_path, timeout):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+class HTTPCheck(NetworkCheck):
+    """Check that a URL can be fetched
+
+    Responses with statuses of 400 or more are faults, unless a
+    ``status`` option gives the expected status.  If a ``contains``
+    option is given, the response body must contain it.
+    """
+
+    def configure_network(self, config):
+        self.address = url = required(config, 'url')
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme == 'http':
+            self.connection_class = HTTPConnection
+        elif parsed.scheme == 'https':
+            self.connection_class = HTTPSConnection
+        else:
+            raise zc.cimaa.parser.Error('bad url: %r' % url)
+        self.netloc = parsed.netloc
+        self.path = parsed.path or '/'
+        if parsed.query:
+            self.path += '?' + parsed.query
+        self.status = config.get('status')
+        if self.status is not None:
+            self.status = int(self.status)
+        self.contains = config.get('contains')
+
+    def probe(self, result):
+        connection = self.connection_class(self.netloc, timeout=self.timeout)
+        try:
+            connection.request('GET', self.path)
+            response = connection.getresponse()
+            body = response.read()
+        finally:
+            connection.close()
+
+        status = response.status
+        result['metrics'].append(dict(name='status', value=status))
+        if (status >= 400 if self.status is None else status != self.status):
+            return "%s: %s %s" % (self.address, status, response.reason)
+        if self.contains is not None and self.contains not in body:
+            return "%s: response doesn't contain %r" % (
+                self.address, self.contains)
+
+# Idle keep-alive connections to monitoring interfaces, by address:
+idle_connections = {}
+# Maximum number of idle connections kept per address:
+max_idle_connections = 4
+
+class MonitorCheck(NetworkCheck):
+    """Get faults and metrics from an application's monitoring interface
+
+    The ``address`` option is either ``HOST:PORT`` or, if it contains
+    a ``/``, the path of a unix-domain socket.  An HTTP GET request is
+    made for the ``path`` option, which defaults to ``/``.  The
+    response is JSON in the same format output by plugins.
+
+    Connections are kept open and reused for later requests to the
+    same address, by this and other checks.  At most
+    ``max_idle_connections`` are kept per address.  They're closed
+    when the check is stopped.
+    """
+
+    def configure_network(self, config):
+        self.address = required(config, 'address')
+        if '/' not in self.address:
+            try:
+                host, port = self.address.rsplit(':', 1)
+                int(port)
+            except ValueError:
+                raise zc.cimaa.parser.Error(
+                    'bad address: %r' % self.address)
+        self.path = config.get('path', '/')
+
+    def connection(self):
+        """Return an idle connection and whether it was used before
+        """
+        idle = idle_connections.get(self.address)
+        if idle:
+            return idle.pop(), True
+        if '/' in self.address:
+            return UnixHTTPConnection(self.address, self.timeout), False
+        else:
+            return HTTPConnection(self.address, timeout=self.timeout), False
+
+    def stop(self):
+        for connection in idle_connections.pop(self.address, ()):
+            connection.close()
+
+    def probe(self, result):
+        while True:
+            connection, reused = self.connection()
+            try:
+                connection.request('GET', self.path)
+                response = connection.getresponse()
+                body = response.read()
+            except socket.timeout:
+                connection.close()
+                raise
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if reused:
+                    # The server probably closed the idle connection.
+                    continue
+                raise
+            except:
+                connection.close()
+                raise
+            break
+
+        idle = idle_connections.setdefault(self.address, [])
+        if response.will_close or len(idle) >= max_idle_connections:
+            connection.close()
+        else:
+            idle.append(connection)
+
+        if response.status != 200:
+            return "%s: %s %s" % (self.address, response.status,
+                                  response.reason)
+
+        data = self.parse_json(body)
+        result['faults'].extend(data.get('faults', ()))
+        result['metrics'].extend(data.get('metrics', ()))
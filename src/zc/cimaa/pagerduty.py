@@ -1,5 +1,6 @@
 import grequests
 import json
+import requests.adapters
 
 api_url = 'https://events.pagerduty.com/generic/2010-04-15/create_event.json'
 
@@ -14,12 +15,18 @@ class Alerter:
             'Content-Type': 'application/json',
             }
         self.service = config['service']
+        # Reuse connections, rather than making new ones for each event:
+        self.session = requests.Session()
+        connections = int(config.get('connections', 10))
+        self.session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=connections))
 
     def _event(self, event_type, name, description):
         if description and len(description) > 1024:
             description = description[:500] + "\n\n...\n\n" + description[-500:]
-        resp = grequests.post(
+        request = grequests.post(
             api_url,
+            session = self.session,
             data = json.dumps(dict(
                 service_key = self.service,
                 incident_key = name,
@@ -28,6 +35,10 @@ class Alerter:
                 )),
             headers = self.headers,
             ).send()
+        resp = request.response
+        if resp is None:
+            # Newer grequests versions save errors rather than raising them
+            raise PagerDutyCallFailed(getattr(request, 'exception', None))
         if resp.status_code != 200:
             raise PagerDutyCallFailed(resp.content)
 
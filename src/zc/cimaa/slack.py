@@ -3,6 +3,11 @@ Post trigger() and resolve() messages to a slack channel
 
 ``target`` may be a '<!channel>' or '<!everyone>' to invoke a slack
 notification to all logged in users.
+
+If ``batch`` is true, messages are collected and posted together when
+the agent calls ``flush`` at the end of each interval, in messages of
+at most ``max_message`` characters (default 4000).  Longer messages
+are split.
 """
 
 import slacker
@@ -18,6 +23,9 @@ class Alerter:
             self.channel = '#' + self.channel
         self.name = 'cimaa'
         self.slack = slacker.Slacker(self.token)
+        self.batch = config.get('batch', 'false').lower() == 'true'
+        self.max_message = int(config.get('max_message', 4000))
+        self.pending = []
 
     def _friendly_name(self, name):
         return '*' + ' '.join(name[2:].split('/', 2)) + '*'
@@ -26,9 +34,99 @@ class Alerter:
         self._post("_*Alert*_: %s: %s" % (self._friendly_name(name) , message))
 
     def _post(self, message):
+        if self.batch:
+            self.pending.append(message)
+        else:
+            self._send(message)
+
+    def _send(self, message):
         if self.target:
             message = ' '.join((self.target, message))
         self.slack.chat.post_message(self.channel, message, username=self.name)
 
     def resolve(self, name):
         self._post("*Clear*: %s" % (self._friendly_name(name)))
+
+    def flush(self):
+        """Post batched messages
+
+        Messages are combined, one per line, into as few posts as
+        possible:
+
+        >>> import mock
+        >>> with mock.patch('slacker.Slacker'):
+        ...     alerter = Alerter(dict(token='xoxb', channel='ops',
+        ...                            batch='true', max_message='100'))
+        >>> alerter.trigger('//app1.example.com/web/http', 'Down')
+        >>> alerter.trigger('//app1.example.com/web/disk', 'Full')
+        >>> alerter.resolve('//app2.example.com/web/http')
+        >>> alerter.slack.chat.post_message.called
+        False
+
+        >>> alerter.flush()
+        >>> for call in alerter.slack.chat.post_message.call_args_list:
+        ...     print call
+        call('#ops', '_*Alert*_: *app1.example.com web http*: Down\\n_*Alert*_: *app1.example.com web disk*: Full', username='cimaa')
+        call('#ops', '*Clear*: *app2.example.com web http*', username='cimaa')
+
+        Messages that can't be posted are kept and posted by the
+        next flush:
+
+        >>> alerter.slack.chat.post_message.reset_mock()
+        >>> alerter.slack.chat.post_message.side_effect = ValueError('rate')
+        >>> alerter.resolve('//app1.example.com/web/http')
+        >>> alerter.flush()
+        Traceback (most recent call last):
+        ...
+        ValueError: rate
+
+        >>> alerter.slack.chat.post_message.side_effect = None
+        >>> alerter.resolve('//app1.example.com/web/disk')
+        >>> alerter.flush()
+        >>> print alerter.slack.chat.post_message.call_args
+        call('#ops', '*Clear*: *app1.example.com web http*\\n*Clear*: *app1.example.com web disk*', username='cimaa')
+        >>> alerter.flush()
+        >>> alerter.slack.chat.post_message.call_count
+        2
+
+        Messages longer than ``max_message`` are split:
+
+        >>> alerter.slack.chat.post_message.reset_mock()
+        >>> alerter.trigger('//app1.example.com/web/log', 'x' * 150)
+        >>> alerter.resolve('//app2.example.com/web/http')
+        >>> alerter.flush()
+        >>> for call in alerter.slack.chat.post_message.call_args_list:
+        ...     print len(call[0][1]), call[0][1][:30]
+        100 _*Alert*_: *app1.example.com w
+        89 xxxxxxxxxxxxxxxxxxxxxxxxxxxxxx
+        36 *Clear*: *app2.example.com web
+
+        The target, which is added to each post, counts against
+        ``max_message``:
+
+        >>> alerter.slack.chat.post_message.reset_mock()
+        >>> alerter.target = '<!channel>'
+        >>> alerter.trigger('//app1.example.com/web/log', 'x' * 150)
+        >>> alerter.resolve('//app2.example.com/web/http')
+        >>> alerter.flush()
+        >>> [len(call[0][1])
+        ...  for call in alerter.slack.chat.post_message.call_args_list]
+        [100, 100, 59]
+        """
+        pending = self.pending
+        max_message = self.max_message
+        if self.target:
+            max_message -= len(self.target) + 1
+        while pending:
+            if len(pending[0]) > max_message:
+                message = pending[0]
+                pending[:1] = [message[i:i + max_message]
+                               for i in range(0, len(message), max_message)]
+            size = len(pending[0])
+            n = 1
+            while (n < len(pending) and
+                   size + 1 + len(pending[n]) <= self.max_message):
+                size += 1 + len(pending[n])
+                n += 1
+            self._send('\n'.join(pending[:n]))
+            del pending[:n]
@@ -0,0 +1,143 @@
+# SQLite implementation, for single-site deployments
+
+import json
+import sqlite3
+import threading
+import time
+
+schema = """
+create table if not exists faults (
+    agent text not null,
+    name text not null,
+    since real not null,
+    data text not null,
+    primary key (agent, name)
+);
+
+create table if not exists heartbeats (
+    agent text primary key,
+    updated real not null
+);
+create index if not exists heartbeats_updated on heartbeats (updated);
+
+create table if not exists squelches (
+    regex text primary key,
+    reason text,
+    user text,
+    time real,
+    permanent integer
+);
+
+create table if not exists leases (
+    name text primary key,
+    holder text not null,
+    expires real not null
+);
+"""
+
+class DB:
+    """Store monitoring data in a local SQLite database file
+
+    The database is used in write-ahead-log mode, so readers, like
+    the meta-monitor and the squelch scripts, don't block agents
+    writing faults.
+
+    The connection can be used from threads, as it is by meta checks,
+    and is used by one thread at a time.
+    """
+
+    def __init__(self, config):
+        self.path = config['path']
+        self.lock = threading.Lock()
+        self.connection = connection = sqlite3.connect(
+            self.path, timeout=float(config.get('timeout', 10)),
+            check_same_thread=False)
+        connection.execute("pragma journal_mode=wal")
+        connection.execute(
+            "pragma synchronous=%s" % config.get('synchronous', 'normal'))
+        connection.executescript(schema)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _select(self, sql, *args):
+        with self.lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    def old_agents(self, age):
+        return [dict(name=agent, updated=updated)
+                for agent, updated in self._select(
+                    "select agent, updated from heartbeats"
+                    " where updated < ? order by agent",
+                    time.time() - age)]
+
+    def get_faults(self, agent):
+        faults = []
+        for since, data in self._select(
+            "select since, data from faults where agent = ? order by name",
+            agent):
+            fault = json.loads(data)
+            fault['since'] = since
+            faults.append(fault)
+        return faults
+
+    def set_faults(self, agent, faults):
+        """Replace an agent's faults and heartbeat in one transaction
+        """
+        now = time.time()
+        with self.lock, self.connection as connection:
+            times = dict(connection.execute(
+                "select name, since from faults where agent = ?", (agent,)))
+            for fault in faults:
+                fault['since'] = times.get(fault['name'], now)
+            connection.execute("delete from faults where agent = ?", (agent,))
+            connection.executemany(
+                "insert into faults values (?, ?, ?, ?)",
+                [(agent, fault['name'], fault['since'],
+                  json.dumps(dict((k, v) for (k, v) in fault.items()
+                                  if k != 'since')))
+                 for fault in faults])
+            connection.execute(
+                "insert or replace into heartbeats values (?, ?)",
+                (agent, now))
+
+    def get_squelches(self):
+        return [regex for (regex,) in self._select(
+            "select regex from squelches order by regex")]
+
+    def get_squelch_details(self):
+        return [dict(regex=regex, reason=reason, user=user, time=time_,
+                     permanent=bool(permanent))
+                for regex, reason, user, time_, permanent
+                in self._select(
+                    "select regex, reason, user, time, permanent"
+                    " from squelches order by regex")]
+
+    def squelch(self, regex, reason, user, permanent=False):
+        with self.lock, self.connection as connection:
+            connection.execute(
+                "insert or replace into squelches values (?, ?, ?, ?, ?)",
+                (regex, reason, user, int(time.time()), int(permanent)))
+
+    def unsquelch(self, regex):
+        with self.lock, self.connection as connection:
+            connection.execute(
+                "delete from squelches where regex = ?", (regex,))
+
+    def acquire_lease(self, name, holder, duration):
+        now = time.time()
+        with self.lock, self.connection as connection:
+            connection.execute(
+                "insert or ignore into leases values (?, ?, 0)",
+                (name, holder))
+            return connection.execute(
+                "update leases set holder = ?, expires = ?"
+                " where name = ? and (holder = ? or expires <= ?)",
+                (holder, now + duration, name, holder, now)).rowcount == 1
+
+    def remove_agent(self, agent):
+        with self.lock, self.connection as connection:
+            connection.execute("delete from faults where agent = ?", (agent,))
+            connection.execute(
+                "delete from heartbeats where agent = ?", (agent,))
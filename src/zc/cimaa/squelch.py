@@ -1,9 +1,75 @@
 import argparse
 import getpass
+import logging
 import os
+import re
 import sys
 import zc.cimaa.parser
 
+logger = logging.getLogger(__name__)
+
+# Inline flags, like (?i), apply to a whole pattern, so patterns using
+# them can't be combined with others.
+has_flags = re.compile(r'\(\?[iLmsux]+\)').search
+
+class Matcher:
+    """Match fault names against squelch regular expressions
+
+    Squelches are compiled once, and only recompiled when they change.
+    Patterns without groups or inline flags are combined into a single
+    regular expression, so names that aren't squelched can usually be
+    ruled out with a single search.
+    """
+
+    squelches = None
+
+    def __init__(self, squelches=()):
+        self.update(squelches)
+
+    def update(self, squelches):
+        squelches = tuple(squelches)
+        if squelches == self.squelches:
+            return
+        self.squelches = squelches
+
+        self.compiled = compiled = []
+        simple = []
+        for squelch in squelches:
+            try:
+                regex = re.compile(squelch)
+            except Exception:
+                logger.exception("Bad squelch %r", squelch)
+                continue
+            compiled.append((squelch, regex))
+            if not (regex.groups or has_flags(squelch)):
+                simple.append(squelch)
+
+        self.search = None
+        self.complex = compiled
+        if simple:
+            try:
+                self.search = re.compile(
+                    '|'.join('(?:%s)' % squelch for squelch in simple)
+                    ).search
+            except Exception:
+                logger.exception("Couldn't combine squelches")
+            else:
+                simple = set(simple)
+                self.complex = [(squelch, regex)
+                                for (squelch, regex) in compiled
+                                if squelch not in simple]
+
+    def match(self, name):
+        """Return the first squelch that matches a name, or None
+        """
+        if self.search is not None and self.search(name):
+            candidates = self.compiled
+        else:
+            candidates = self.complex
+        for squelch, regex in candidates:
+            if regex.search(name):
+                return squelch
+
 
 def getuser():
     user = getpass.getuser()
@@ -1,34 +1,146 @@
 """Stub plugin implementations for testing and debugging
 """
+import bisect
 import gevent
 import json
 import pprint
+import threading
 import time
 
 class MemoryDB:
+    """Database that keeps data in memory
+
+    It's fast enough to simulate large numbers of agents.  Agent
+    update times are indexed, so finding old agents doesn't require
+    looking at every agent:
+
+    >>> db = MemoryDB({})
+    >>> for i in range(5):
+    ...     db.set_faults('agent%s' % i, [], now=100 + i)
+    >>> with mock.patch('time.time', return_value=110):
+    ...     pp(db.old_agents(7))
+    [{'name': 'agent0', 'updated': 100}, {'name': 'agent1', 'updated': 101},
+     {'name': 'agent2', 'updated': 102}]
+
+    Fault ``since`` times are kept while faults persist:
+
+    >>> db.set_faults('agent0', [dict(name='f', updated=200)], now=200)
+    >>> db.set_faults('agent0', [dict(name='f', updated=260)], now=260)
+    >>> db.get_faults('agent0')
+    [{'updated': 260, 'since': 200, 'name': 'f'}]
+    >>> db.set_faults('agent0', [], now=320)
+    >>> db.set_faults('agent0', [dict(name='f', updated=380)], now=380)
+    >>> db.get_faults('agent0')
+    [{'updated': 380, 'since': 380, 'name': 'f'}]
+
+    If a ``path`` option is given, agent faults and squelches are also
+    saved to a SQLite database file, and loaded when a database is
+    created:
+
+    >>> db = MemoryDB(dict(path='memory.db'))
+    >>> db.set_faults('agent0', [dict(name='f', updated=200)], now=200)
+    >>> db.set_faults('agent1', [], now=260)
+    >>> db.squelch('agent1', 'testing', 'tester', now=300)
+    >>> db.remove_agent('agent1')
+    >>> db.close()
+
+    >>> db = MemoryDB(dict(path='memory.db'))
+    >>> db.get_faults('agent0')
+    [{u'updated': 200, u'since': 200, u'name': u'f'}]
+    >>> pp(db.old_agents(0))
+    [{'name': u'agent0', 'updated': 200.0}]
+    >>> db.get_squelches()
+    [u'agent1']
+    >>> db.unsquelch('agent1')
+
+    The database file can be written from threads, as when a meta
+    check runs in the agent:
+
+    >>> gevent.get_hub().threadpool.apply(db.set_faults, ('agent2', []))
+    >>> db.close()
+    >>> pp(MemoryDB(dict(path='memory.db')).old_agents(0))
+    [{'name': u'agent0', 'updated': 200.0}, {'name': u'agent2', 'updated': ...}]
+    >>> MemoryDB(dict(path='memory.db')).get_squelches()
+    []
+
+    There's a benchmark that simulates a fleet of agents:
+
+    >>> import zc.cimaa.bench
+    >>> zc.cimaa.bench.fleet(10, 2)
+        agents     faults   set_faults   old_agents
+            10          2     ...
+    """
+
+    connection = None
 
     def __init__(self, config):
         self.faults = json.loads(config.get('faults', '{}'))
         self.squelches = {}
-        self.agents = {}
+        self.agents = {} # {agent: updated}
+        self.updated = [] # [(updated, agent)], sorted
+        self.leases = {} # {name: (holder, expires)}
+        self.path = config.get('path')
+        if self.path:
+            self._load()
+
+    def _load(self):
+        import sqlite3
+        self.lock = threading.Lock()
+        self.connection = connection = sqlite3.connect(
+            self.path, check_same_thread=False)
+        with connection:
+            connection.execute(
+                "create table if not exists agents"
+                " (name text primary key, updated real, faults text)")
+            connection.execute(
+                "create table if not exists squelches"
+                " (regex text primary key, data text)")
+        for name, updated, faults in connection.execute(
+            "select name, updated, faults from agents"):
+            self.faults[name] = json.loads(faults)
+            self._set_updated(name, updated)
+        for regex, data in connection.execute(
+            "select regex, data from squelches"):
+            self.squelches[regex] = json.loads(data)
+
+    def _save(self, sql, *args):
+        if self.connection is not None:
+            with self.lock, self.connection:
+                self.connection.execute(sql, args)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _set_updated(self, agent, updated):
+        old = self.agents.pop(agent, None)
+        if old is not None:
+            del self.updated[bisect.bisect_left(self.updated, (old, agent))]
+        if updated is not None:
+            self.agents[agent] = updated
+            bisect.insort(self.updated, (updated, agent))
 
     def old_agents(self, age):
         max_updated = time.time() - age
-        return [dict(name=k, updated=v) for k, v in self.agents.items()
-                if v < max_updated]
+        return [dict(name=agent, updated=updated)
+                for updated, agent in self.updated[
+                    :bisect.bisect_left(self.updated, (max_updated,))]]
 
     def get_faults(self, agent):
         return self.faults.get(agent, ())
 
     def set_faults(self, agent, faults, now=None):
         times = {
-            f[name]: f['since']
-            for f in self.faults.get('agent', ()) if f['name']
+            f['name']: f['since']
+            for f in self.faults.get(agent, ()) if 'since' in f
             }
         for f in faults:
             f['since'] = times.get(f['name'], f['updated'])
         self.faults[agent] = faults
-        self.agents[agent] = now or time.time()
+        self._set_updated(agent, now or time.time())
+        self._save("insert or replace into agents values (?, ?, ?)",
+                   agent, self.agents[agent], json.dumps(faults))
 
     def get_squelches(self):
         return sorted(self.squelches)
@@ -38,21 +150,32 @@ class MemoryDB:
                 for item in sorted(self.squelches.items())]
 
     def squelch(self, regex, reason, user, permanent=False, now=None):
-        self.squelches[regex] = dict(
+        self.squelches[regex] = data = dict(
             reason = reason,
             user = user,
             time = now or 1417968068.01,
             permanent = permanent,
             )
+        self._save("insert or replace into squelches values (?, ?)",
+                   regex, json.dumps(data))
 
     def unsquelch(self, regex):
         del self.squelches[regex]
+        self._save("delete from squelches where regex = ?", regex)
+
+    def acquire_lease(self, name, holder, duration):
+        now = time.time()
+        lease = self.leases.get(name)
+        if lease is None or lease[0] == holder or lease[1] <= now:
+            self.leases[name] = holder, now + duration
+            return True
+        return False
 
     def remove_agent(self, agent):
-        if agent in self.agents:
-            del self.agents[agent]
+        self._set_updated(agent, None)
         if agent in self.faults:
             del self.faults[agent]
+        self._save("delete from agents where name = ?", agent)
 
     def __str__(self):
         return pprint.pformat(self.faults)
@@ -62,6 +185,81 @@ def _squelch_detail((regex, data)):
     data['regex'] = regex
     return data
 
+class LocalTable:
+    """In-memory stand-in for the boto DynamoDB tables we use
+
+    Queries can be made from multiple threads.  We keep track of how
+    many run at once.  Each request to the table takes ``latency``
+    seconds, to simulate network latency.
+    """
+
+    latency = .01
+    batching = False
+
+    def __init__(self, conn, prefix, name):
+        import zc.cimaa.dynamodb
+        self.name = prefix + name
+        self.keys = [field.name for field in
+                     zc.cimaa.dynamodb.schemas[name]['schema']]
+        self.items = {}
+        self.queries = self.active = self.max_active = self.scans = 0
+        self.lock = threading.Lock()
+
+    def _key(self, data):
+        return tuple(data[name] for name in self.keys)
+
+    def _request(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put_item(self, data, overwrite=False):
+        if not self.batching:
+            self._request()
+        self.items[self._key(data)] = dict(data)
+
+    def delete_item(self, **key):
+        if not self.batching:
+            self._request()
+        self.items.pop(self._key(key), None)
+
+    def lookup(self, *key):
+        import boto.dynamodb2.exceptions
+        self._request()
+        try:
+            return dict(self.items[key])
+        except KeyError:
+            raise boto.dynamodb2.exceptions.ItemNotFound(key)
+
+    def batch_write(self):
+        return self
+
+    def __enter__(self):
+        self.batching = True
+        return self
+
+    def __exit__(self, *args):
+        self.batching = False
+        self._request()
+
+    def scan(self, attributes=None):
+        self._request()
+        self.scans += 1
+        return [dict(item) for key, item in sorted(self.items.items())]
+
+    def query_2(self, index=None, agent__eq=None, updated__lt=None):
+        with self.lock:
+            self.queries += 1
+            self.active += 1
+            self.max_active = max(self.active, self.max_active)
+        try:
+            self._request()
+            return [dict(item) for key, item in sorted(self.items.items())
+                    if item['agent'] == agent__eq and
+                    (updated__lt is None or item['updated'] < updated__lt)]
+        finally:
+            with self.lock:
+                self.active -= 1
+
 
 class OutputAlerter:
 
@@ -93,6 +93,33 @@ def setUpWithoutLogging(test):
     setUp(test)
     setupstack.context_manager(test, mock.patch('time.sleep'))
 
+def setUpLocalTables(test):
+    # Use in-memory stand-ins for DynamoDB tables
+    tables = {}
+    def table(conn, prefix, name):
+        if name not in tables:
+            tables[name] = zc.cimaa.stub.LocalTable(conn, prefix, name)
+        return tables[name]
+    setupstack.context_manager(
+        test, mock.patch('zc.cimaa.dynamodb.connect',
+                         return_value=(None, 'test.')))
+    setupstack.context_manager(
+        test, mock.patch('zc.cimaa.dynamodb.table', side_effect=table))
+    test.globs['tables'] = tables
+
+def setUpDynamo(test):
+    setUpPP(test)
+    setUpLocalTables(test)
+
+def setUpMeta(test):
+    setUpLogging(test)
+    setUpLocalTables(test)
+
+def setUpStub(test):
+    setUpPP(test)
+    setupstack.setUpDirectory(test)
+    test.globs['mock'] = mock
+
 def setUpTime(test):
     setUpLogging(test)
     globs = test.globs
@@ -104,19 +131,27 @@ def setUpTime(test):
 def test_suite():
     optionflags = doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS
     time_pat = r"\d{5,}(\.\d+)?"
+    checker = renormalizing.OutputChecker([
+        (re.compile(r"'agents': {'test.example.com': "+time_pat),
+         "'agents': {'test.example.com': "),
+        (re.compile(r"u?'since': "+time_pat), 'SINCE'),
+        (re.compile(r"u?'updated': "+time_pat), 'UPDATED'),
+        ])
     suite = unittest.TestSuite((
         manuel.testing.TestSuite(
             manuel.doctest.Manuel(
                 optionflags=optionflags,
-                checker=renormalizing.OutputChecker([
-                    (re.compile(r"'agents': {'test.example.com': "+time_pat),
-                     "'agents': {'test.example.com': "),
-                    (re.compile(r"u?'since': "+time_pat), 'SINCE'),
-                    (re.compile(r"u?'updated': "+time_pat), 'UPDATED'),
-                    ])
+                checker=checker,
                 ) + manuel.capture.Manuel(),
-            'agent.rst', 'meta.rst', 'schedule.rst', 'squelch.rst',
+            'agent.rst', 'netcheck.rst', 'schedule.rst', 'squelch.rst',
             setUp=setUpLogging, tearDown=setupstack.tearDown),
+        manuel.testing.TestSuite(
+            manuel.doctest.Manuel(
+                optionflags=optionflags,
+                checker=checker,
+                ) + manuel.capture.Manuel(),
+            'meta.rst',
+            setUp=setUpMeta, tearDown=setupstack.tearDown),
         manuel.testing.TestSuite(
             manuel.doctest.Manuel(
                 optionflags=optionflags,
@@ -129,11 +164,28 @@ def test_suite():
                 ) + manuel.capture.Manuel(),
             'agent-loop.rst',
             setUp=setUpWithoutLogging, tearDown=setupstack.tearDown),
+        manuel.testing.TestSuite(
+            manuel.doctest.Manuel(
+                optionflags=optionflags,
+                ) + manuel.capture.Manuel(),
+            'heartbeats.rst',
+            setUp=setUpDynamo, tearDown=setupstack.tearDown),
+        manuel.testing.TestSuite(
+            manuel.doctest.Manuel(
+                optionflags=optionflags,
+                ) + manuel.capture.Manuel(),
+            'sqlite.rst',
+            setUp=setUpLogging, tearDown=setupstack.tearDown),
         doctest.DocTestSuite('zc.cimaa.nagiosperf', optionflags=optionflags),
         doctest.DocTestSuite('zc.cimaa.threshold',
                              optionflags=optionflags,
                              setUp=setUpPP),
         doctest.DocTestSuite('zc.cimaa.agent', optionflags=optionflags),
+        doctest.DocTestSuite('zc.cimaa.slack', optionflags=optionflags),
+        doctest.DocTestSuite('zc.cimaa.util', optionflags=optionflags),
+        doctest.DocTestSuite('zc.cimaa.stub', optionflags=optionflags,
+                             setUp=setUpStub,
+                             tearDown=setupstack.tearDown),
         ))
     if 'DYNAMO_TEST' in os.environ:
         suite.addTest(
@@ -44,8 +44,120 @@ Errors stick even when we drop below error level until they clear
     {'message': '60 > 50', 'severity': 30}
     >>> r([dict(name='foo', value=40)])
 
+Once cleared, values below the error level are no longer errors:
+
+    >>> pp(r([dict(name='foo', value=90)]))
+    {'message': '90 > 50', 'severity': 30}
+
+Thresholds can apply to many metrics using glob patterns or, with a
+``re:`` prefix, regular expressions.  Faults are named after the
+metrics that caused them:
+
+    >>> t = Thresholds('''
+    ...     /var/* critical > 90 warning > 80
+    ...     re:^load[0-9]+$ ? warning > 4
+    ...     other ? warning > 1
+    ...     ''')
+    >>> results = dict(faults=[], metrics=[
+    ...     dict(name='/var/log', value=95), dict(name='/var/tmp', value=85),
+    ...     dict(name='/var/lib', value=10), dict(name='/home', value=99),
+    ...     dict(name='load1', value=5), dict(name='load15', value=3),
+    ...     ])
+    >>> t(results)
+    >>> pp(results['faults'])
+    [{'message': '95 > 90', 'name': '/var/log', 'severity': 50},
+     {'message': '85 > 80', 'name': '/var/tmp', 'severity': 30},
+     {'message': '5 > 4', 'name': 'load1', 'severity': 30}]
+
+If no metrics match a pattern, that's a missing metric, unless the
+threshold is optional:
+
+    >>> results = dict(faults=[], metrics=[])
+    >>> t(results)
+    >>> pp(results['faults'])
+    [{'escalates': False,
+      'message': 'Missing metric',
+      'name': '/var/*',
+      'severity': 40}]
+
+Bad regular expressions are invalid definitions:
+
+    >>> Threshold('re:load[ warning > 4')
+    Traceback (most recent call last):
+    ...
+    ValueError: ('Invalid threshold definition, %r (%s)', 're:load[ warning > 4', error(...))
+
+Metric values are indexed by name once for all of the thresholds.
+There's a micro-benchmark comparing this to scanning the metrics for
+each threshold:
+
+    >>> import zc.cimaa.bench
+    >>> zc.cimaa.bench.thresholds(10, 5)
+       metrics thresholds         scan        index
+            10          5     ...
+
+Thresholds can apply to aggregates of the last few values of a
+metric, rather than to the current value.  An aggregate follows the
+name (and optional flag) and is one of ``avg(N)``, ``min(N)``,
+``max(N)``, ``pNN(N)`` (the NNth percentile), or ``rate`` (the change
+per second since the previous value).  ``rate(N)`` gives the rate over
+the last N values.  Until there are N values, aggregates use the values
+there are:
+
+    >>> a = Threshold('foo avg(3) warning > 50')
+    >>> pp(a.check([dict(name='foo', value=90)], 0))
+    {'message': 'avg(3) 90.0 > 50', 'severity': 30}
+    >>> a.check([dict(name='foo', value=0)], 60)
+    >>> pp(a.check([dict(name='foo', value=90)], 120))
+    {'message': 'avg(3) 60.0 > 50', 'severity': 30}
+    >>> a.check([dict(name='foo', value=0)], 180)
+
+    >>> p = Threshold('foo p50(4) error > 5')
+    >>> [p.check([dict(name='foo', value=v)], 0) for v in (9, 1, 2, 9)]
+    [{'message': 'p50(4) 9.0 > 5', 'severity': 40}, None, None, None]
+    >>> p.check([dict(name='foo', value=9)], 0)
+    >>> pp(p.check([dict(name='foo', value=9)], 0))
+    {'message': 'p50(4) 9.0 > 5', 'severity': 40}
+
+A rate needs at least two values:
+
+    >>> r = Threshold('requests rate critical > 10')
+    >>> r.check([dict(name='requests', value=1000)], 0)
+    >>> r.check([dict(name='requests', value=1600)], 60)
+    >>> pp(r.check([dict(name='requests', value=2800)], 120))
+    {'message': 'rate 20.0 > 10', 'severity': 50}
+    >>> r.check([], 180)['message']
+    'Missing metric'
+
+When a metric is missing, its values are forgotten:
+
+    >>> r.check([dict(name='requests', value=5000)], 240)
+
+Values are kept in small fixed-size arrays, one per metric name, so
+memory use is bounded.  ``window_bytes`` estimates the memory used per
+metric:
+
+    >>> 150 < window_bytes(5) < window_bytes(30) < 500
+    True
+    >>> window_bytes(30, timed=True) - window_bytes(30) <= 30 * 8 + 64
+    True
+
+With 30-value windows, 5000 tracked metrics use about 2MB.
+
+Aggregates other than ``rate`` need a window size:
+
+    >>> Threshold('foo avg warning > 1')
+    Traceback (most recent call last):
+    ...
+    ValueError: ('Invalid threshold definition, %r (%s)', 'foo avg warning > 1', ValueError("Missing window size in 'avg'",))
+
 """
+import array
+import fnmatch
 import logging
+import math
+import re
+import time
 
 class Thresholds:
 
@@ -56,26 +168,60 @@ class Thresholds:
             if line]
 
     def __call__(self, results):
-        metrics = results.get('metrics', ())
+        values = index(results.get('metrics', ()))
+        faults = results['faults']
+        now = time.time()
         for threshold in self.thresholds:
-            f = threshold.check(metrics)
-            if f is not None:
-                f['name'] = threshold.name
-                results['faults'].append(f)
+            for name, f in threshold.faults(values, now):
+                f['name'] = name
+                faults.append(f)
+
+def index(metrics):
+    """Return a dictionary of metric values by name
+    """
+    values = {}
+    for m in metrics:
+        values.setdefault(m['name'], m['value'])
+    return values
 
 class Threshold:
+    """Threshold for one metric, or for metrics with matching names
 
-    optional = bad = False
+    If the name starts with ``re:``, the rest is a regular expression
+    to search metric names with.  If it contains any of the glob
+    characters ``*``, ``?`` or ``[``, it's a glob pattern that must
+    match entire metric names.
+    """
+
+    optional = False
     warning = error = critical = clear = None
+    match = None
+    window = None # Aggregate function and number of samples
 
-    def __init__(self, definition):
-        tokens = definition.strip().split()
-        self.name = tokens.pop(0)
-        if tokens[0] in ('?', 'optional'):
-            self.optional = True
-            tokens.pop(0)
+    # Limit on the number of remembered pattern matches:
+    max_matches = 10000
 
+    def __init__(self, definition):
+        self.bad = set() # Names of metrics that haven't cleared
         try:
+            tokens = definition.strip().split()
+            self.name = tokens.pop(0)
+            if self.name.startswith('re:'):
+                self.match = re.compile(self.name[3:]).search
+            elif glob_chars(self.name):
+                self.match = re.compile(fnmatch.translate(self.name)).match
+            if self.match is not None:
+                self.matches = {}
+
+            if tokens[0] in ('?', 'optional'):
+                self.optional = True
+                tokens.pop(0)
+
+            aggregate = parse_aggregate(tokens[0])
+            if aggregate is not None:
+                self.label = tokens.pop(0)
+                self.window = aggregate
+                self.windows = {}
             while tokens:
                 level = tokens.pop(0).lower()
                 if level not in levels:
@@ -91,33 +237,95 @@ class Threshold:
             raise ValueError("Invalid threshold definition, %r (%s)",
                              definition, v)
 
-    def check(self, metrics):
-        v = [m for m in metrics if m['name'] == self.name]
-        if not v:
+    def check(self, metrics, now=None):
+        """Check a sequence of metrics, returning a fault or None
+        """
+        faults = self.faults(index(metrics), now)
+        if faults:
+            return faults[0][1]
+
+    def faults(self, values, now=None):
+        """Check metric values by name
+
+        Return a list of metric names and faults.
+        """
+        if self.match is None:
+            names = [self.name] if self.name in values else ()
+        else:
+            names = sorted(name for name in values if self.matched(name))
+
+        if self.window is not None:
+            values = self.aggregate(names, values,
+                                    time.time() if now is None else now)
+            if names:
+                # Without enough samples, there's nothing to check yet.
+                names = [name for name in names if values[name] is not None]
+                if not names:
+                    return []
+
+        if not names:
             if not self.optional:
-                return dict(
+                return [(self.name, dict(
                     escalates=False,
                     message='Missing metric',
                     severity=logging.ERROR,
-                    )
-            return
-        [v] = v
-        v = v['value']
+                    ))]
+            return []
+
+        faults = []
+        for name in names:
+            f = self.check_value(name, values[name])
+            if f is not None:
+                if self.window is not None:
+                    f['message'] = self.label + ' ' + f['message']
+                faults.append((name, f))
+        return faults
+
+    def aggregate(self, names, values, now):
+        """Add values to windows, returning aggregated values
+
+        The aggregated value is None if there isn't enough data yet.
+        Windows for metrics we didn't get values for are discarded.
+        """
+        function, size = self.window
+        windows = self.windows
+        for name in list(windows):
+            if name not in values:
+                del windows[name]
+        result = {}
+        for name in names:
+            window = windows.get(name)
+            if window is None:
+                window = windows[name] = Window(size, function is rate)
+            window.add(values[name], now)
+            result[name] = function(window)
+        return result
 
+    def matched(self, name):
+        matches = self.matches
+        try:
+            return matches[name]
+        except KeyError:
+            if len(matches) >= self.max_matches:
+                matches.clear()
+            matched = matches[name] = self.match(name) is not None
+            return matched
+
+    def check_value(self, name, v):
         if self.critical and self.critical[0](v):
-            self.bad = True
+            self.bad.add(name)
             return dict(severity = logging.CRITICAL,
                         message  = self.critical[1] % v,
                         )
         if self.error and self.error[0](v):
-            self.bad = True
+            self.bad.add(name)
             return dict(severity = logging.ERROR,
                         message  = self.error[1] % v,
                         )
 
-        if self.bad and self.clear:
+        if name in self.bad and self.clear:
             if self.clear[0](v):
-                bad = None
+                self.bad.discard(name)
             else:
                 return dict(severity = logging.ERROR,
                             message  = self.clear[1] % v,
@@ -130,6 +338,102 @@ class Threshold:
 
         return None
 
+glob_chars = re.compile(r'[*?[]').search
+
+class Window:
+    """The last few values (and, optionally, times) of a metric
+
+    Values are kept in fixed-size arrays of doubles, used as ring
+    buffers.  See ``window_bytes`` for the memory used.
+    """
+
+    __slots__ = ('values', 'times', 'size', 'count', 'next')
+
+    def __init__(self, size, timed=False):
+        self.values = array.array('d', [0.0]) * size
+        self.times = array.array('d', [0.0]) * size if timed else None
+        self.size = size
+        self.count = self.next = 0
+
+    def add(self, value, now):
+        self.values[self.next] = value
+        if self.times is not None:
+            self.times[self.next] = now
+        self.next = (self.next + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def oldest(self):
+        """Return the index of the oldest value"""
+        return (self.next - self.count) % self.size
+
+    def newest(self):
+        """Return the index of the newest value"""
+        return (self.next - 1) % self.size
+
+    def __iter__(self):
+        values = self.values
+        if self.count < self.size:
+            return iter(values[:self.count])
+        return iter(values)
+
+def average(window):
+    return sum(window) / window.count
+
+def rate(window):
+    """Change per second between the oldest and newest values"""
+    if window.count < 2:
+        return None
+    oldest = window.oldest()
+    newest = window.newest()
+    elapsed = window.times[newest] - window.times[oldest]
+    if elapsed <= 0:
+        return None
+    return (window.values[newest] - window.values[oldest]) / elapsed
+
+def percentile(p):
+    def percentile(window):
+        values = sorted(window)
+        # nearest rank
+        return values[max(int(math.ceil(p * len(values) / 100.0)), 1) - 1]
+    return percentile
+
+aggregate_syntax = re.compile(
+    r'(avg|max|min|rate|p(\d\d?))(\((\d+)\))?$').match
+
+def parse_aggregate(token):
+    """Parse an aggregate, returning a function and window size, or None
+    """
+    m = aggregate_syntax(token)
+    if m is None:
+        return None
+    name, p, _, size = m.groups()
+    if name == 'rate':
+        size = int(size or 2)
+        function = rate
+    elif size is None:
+        raise ValueError("Missing window size in %r" % token)
+    elif p is not None:
+        function = percentile(int(p))
+    else:
+        function = dict(avg=average, max=max, min=min)[name]
+    size = int(size)
+    if size < 1 or (function is rate and size < 2):
+        raise ValueError("Bad window size in %r" % token)
+    return function, size
+
+def window_bytes(size, timed=False):
+    """Approximate memory used by a window of the given size
+
+    This includes the window, its arrays and its dictionary entry,
+    but not the metric name, which is shared with the metric data.
+    """
+    import sys
+    window = Window(size, timed)
+    return (sys.getsizeof(window) + sys.getsizeof(window.values) +
+            (sys.getsizeof(window.times) if timed else 0) +
+            24) # Rough per-entry cost of a dictionary
+
 levels = ('warning', 'error', 'critical', 'clear')
 
 ops = {
@@ -0,0 +1,29 @@
+"""Utilities shared by agent components
+"""
+import gevent
+import sys
+
+def threadpool_apply(func, *args):
+    """Call a function in the gevent hub's thread pool and return the result
+
+    This is used to call blocking code, like boto, without blocking
+    other greenlets.  Unlike the thread pool's ``apply`` method in
+    gevent 1.0, errors are raised in the caller:
+
+    >>> threadpool_apply(int, '42')
+    42
+    >>> threadpool_apply(int, 'x')
+    Traceback (most recent call last):
+    ...
+    ValueError: invalid literal for int() with base 10: 'x'
+    """
+    ok, result = gevent.get_hub().threadpool.apply(_call, (func, args))
+    if not ok:
+        raise result[0], result[1], result[2]
+    return result
+
+def _call(func, args):
+    try:
+        return True, func(*args)
+    except Exception:
+        return False, sys.exc_info()